@@ -0,0 +1,782 @@
+"""Local stand-in for the OrientDB REST server, for benchmarking the client
+without a database. It keeps an in-memory graph and understands the REST
+endpoints and the subset of the SQL-like language that py2orientdb sends:
+connect, query/command, document, batch, property, class, database and
+export. Single-property indexes are used for ``=`` and ``IN`` conditions
+and reported by EXPLAIN, as OrientDB 2.x does. Every request can be
+delayed by a fixed ``latency`` to mimic a remote server.
+
+Run it on its own with:
+
+    python benchmarks/mock_orientdb.py --port 2480 --vertices 10000
+"""
+
+import BaseHTTPServer
+import SocketServer
+import argparse
+import gzip
+import json
+import random
+import re
+import socket
+import sys
+import threading
+import time
+import urllib2
+from StringIO import StringIO
+
+
+class MockDatabase(object):
+    """In-memory store of records, keyed by @rid, grouped into classes.
+       Each class gets its own cluster, so @rids within a class are
+       increasing, as they are in OrientDB. Indexes map tuples of property
+       values to sets of @rids; unique indexes reject duplicate keys.
+    """
+    def __init__(self):
+        self.records = {}
+        self.classes = {}
+        self.indexes = {}
+        self.lock = threading.RLock()
+        for name, superclass in (('V', None), ('E', None)):
+            self.create_class(name, superclass)
+
+    def create_class(self, name, superclass=None):
+        with self.lock:
+            if name in self.classes:
+                raise ValueError('Class %s already exists.' % (name))
+            self.classes[name] = {
+                'name': name, 'superClass': superclass,
+                'cluster': 9 + len(self.classes), 'next_position': 0,
+                'properties': {}}
+
+    def class_of(self, name):
+        for class_name in self.classes:
+            if class_name.lower() == name.lower():
+                return self.classes[class_name]
+        raise KeyError('Class %s not found.' % (name))
+
+    def subclasses(self, name):
+        """Returns the names of ``name`` and all the classes extending it."""
+        name = self.class_of(name)['name']
+        names = set([name])
+        changed = True
+        while changed:
+            changed = False
+            for class_name, d in self.classes.iteritems():
+                if d['superClass'] in names and class_name not in names:
+                    names.add(class_name)
+                    changed = True
+        return names
+
+    def create_index(self, name, class_name, fields, index_type):
+        with self.lock:
+            if name in self.indexes:
+                raise ValueError('Index %s already exists.' % (name))
+            index = {
+                'name': name, 'type': index_type.upper(), 'fields': fields,
+                'className': self.class_of(class_name)['name'],
+                'entries': {}}
+            for record in self.scan(class_name):
+                self.index_add(index, record)
+            self.indexes[name] = index
+
+    def rebuild_index(self, name):
+        with self.lock:
+            names = self.indexes.keys() if name == '*' else [name]
+            for name in names:
+                index = self.indexes[name]
+                index['entries'] = {}
+                for record in self.scan(index['className']):
+                    self.index_add(index, record)
+            return len(names)
+
+    def indexes_of(self, class_name):
+        """Returns the indexes that cover records of ``class_name``."""
+        return [index for index in self.indexes.itervalues()
+                if class_name in self.subclasses(index['className'])]
+
+    def index_add(self, index, record):
+        key = tuple(get_path(record, field) for field in index['fields'])
+        if key == (None,) * len(key):
+            return
+        rids = index['entries'].setdefault(key, set())
+        if (index['type'].startswith('UNIQUE') and len(rids) > 0 and
+                record['@rid'] not in rids):
+            raise ValueError('Duplicated key %r in index %s.' % (
+                key, index['name']))
+        rids.add(record['@rid'])
+
+    def index_remove(self, index, record):
+        key = tuple(get_path(record, field) for field in index['fields'])
+        index['entries'].get(key, set()).discard(record['@rid'])
+
+    def insert(self, class_name, content):
+        with self.lock:
+            cls = self.class_of(class_name)
+            rid = '#%d:%d' % (cls['cluster'], cls['next_position'])
+            record = dict(content)
+            record.update({
+                '@rid': rid, '@class': cls['name'], '@version': 1,
+                '@type': 'd'})
+            indexes = self.indexes_of(cls['name'])
+            for index in indexes:
+                self.index_add(index, record)
+            cls['next_position'] += 1
+            self.records[rid] = record
+            return record
+
+    def create_edge(self, class_name, source, target, content):
+        with self.lock:
+            edge = self.insert(class_name, content)
+            edge['out'] = source
+            edge['in'] = target
+            for rid, direction in ((source, 'out'), (target, 'in')):
+                vertex = self.records[rid]
+                field = '%s_%s' % (direction, edge['@class'])
+                vertex.setdefault(field, []).append(edge['@rid'])
+                vertex['@version'] += 1
+            return edge
+
+    def update(self, rid, content, merge):
+        with self.lock:
+            record = self.records[rid]
+            indexes = self.indexes_of(record['@class'])
+            for index in indexes:
+                self.index_remove(index, record)
+            if not merge:
+                for k in [k for k in record if k[0] != '@']:
+                    del record[k]
+            record.update(content)
+            record['@version'] += 1
+            for index in indexes:
+                self.index_add(index, record)
+            return record
+
+    def delete(self, rid):
+        with self.lock:
+            record = self.records.pop(rid, None)
+            if record is None:
+                return 0
+            for index in self.indexes_of(record['@class']):
+                self.index_remove(index, record)
+            return 1
+
+    def lookup(self, class_name, tests):
+        """Finds the records of ``class_name`` for a list of (field,
+           operator, operand) tests with an index on an ``=`` or ``IN``
+           test. Returns the index and its candidate records, or None and
+           None if no index applies.
+        """
+        for index in self.indexes_of(self.class_of(class_name)['name']):
+            if len(index['fields']) != 1:
+                continue
+            for field, operator, operand in tests:
+                if field != index['fields'][0]:
+                    continue
+                if operator == '=':
+                    values = [operand]
+                elif operator == 'IN':
+                    values = operand
+                else:
+                    continue
+                rids = set()
+                for value in values:
+                    rids.update(index['entries'].get((value,), ()))
+                return index, [self.records[rid] for rid in rids]
+        return None, None
+
+    def scan(self, class_name):
+        """Returns the records of ``class_name`` and its subclasses."""
+        names = self.subclasses(class_name)
+        with self.lock:
+            return [r for r in self.records.itervalues()
+                    if r['@class'] in names]
+
+
+def rid_key(rid):
+    cluster, position = rid.lstrip('#').split(':')
+    return int(cluster), int(position)
+
+
+COMPARISONS = {
+    '=': lambda a, b: a == b, '>': lambda a, b: a > b,
+    '<': lambda a, b: a < b, '>=': lambda a, b: a >= b,
+    '<=': lambda a, b: a <= b}
+
+
+def split_target(text):
+    """Splits the text after FROM into the target (a class, rid, list of
+       rids or parenthesized subquery) and the rest of the query.
+    """
+    text = text.strip()
+    if text[:1] not in '([':
+        return re.match(r'(\S+)(.*)$', text, re.S).groups()
+    closing = {'(': ')', '[': ']'}
+    depth = 0
+    for i, character in enumerate(text):
+        if character in closing:
+            depth += 1
+        elif character in closing.values():
+            depth -= 1
+            if depth == 0:
+                return text[:i + 1], text[i + 1:]
+    raise ValueError('Unbalanced target %r.' % (text))
+
+
+def get_path(record, key_path):
+    value = record
+    for key in key_path.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+class Statement(object):
+    """Executes one SQL statement against a ``MockDatabase``."""
+    def __init__(self, database, parameters=None, variables=None):
+        self.database = database
+        self.parameters = parameters
+        self.variables = variables if variables is not None else {}
+        self.positional = 0
+        self.involved_indexes = []
+        self.depths = {}
+
+    def value(self, text):
+        """Evaluates a literal, parameter, rid or $variable."""
+        text = text.strip()
+        if text == '?':
+            value = self.parameters[self.positional]
+            self.positional += 1
+            return value
+        if text.startswith(':'):
+            return self.parameters[text[1:]]
+        if text.startswith('$'):
+            return self.variables[text[1:]]
+        if text.startswith('#'):
+            return text
+        return json.loads(text)
+
+    def rid_of(self, text):
+        value = self.value(text)
+        if isinstance(value, list):
+            value = value[0]
+        if isinstance(value, dict):
+            value = value['@rid']
+        return value
+
+    def condition(self, text):
+        """Parses a WHERE clause of ANDed comparisons into a list of
+           (field, operator, operand) tests.
+        """
+        text = text.strip()
+        while text.startswith('(') and text.endswith(')'):
+            text = text[1:-1].strip()
+        tests = []
+        for part in re.split(r'\s+AND\s+', text, flags=re.I):
+            part = part.strip().strip('()').strip()
+            match = re.match(r'^(\S+)\s+(>=|<=|=|>|<|IN)\s+(.+)$', part,
+                             re.I)
+            if match is None:
+                raise ValueError('Unsupported condition %r.' % (part))
+            field, operator, operand = match.groups()
+            operand = self.value(operand)
+            tests.append((field, operator.upper(), operand))
+        return tests
+
+    def matches(self, record, tests):
+        for field, operator, operand in tests:
+            if field == '$depth':
+                value = self.depths.get(record['@rid'], 0)
+            else:
+                value = get_path(record, field)
+            if operator == 'IN':
+                if value not in operand:
+                    return False
+                continue
+            if field == '@rid':
+                value, operand = rid_key(value), rid_key(operand)
+            if not COMPARISONS[operator](value, operand):
+                return False
+        return True
+
+    def find(self, class_name, tests):
+        """Returns the index used, if any, and the records of
+           ``class_name`` passing ``tests``.
+        """
+        index, records = self.database.lookup(class_name, tests)
+        if index is None:
+            records = self.database.scan(class_name)
+        return index, [r for r in records if self.matches(r, tests)]
+
+    def select(self, text):
+        match = re.match(r'^SELECT\s+(.*?)\s*FROM\s+(.*)$', text, re.I | re.S)
+        if match is None:
+            raise ValueError('Unsupported query %r.' % (text))
+        projection = match.group(1)
+        target, rest = split_target(match.group(2))
+        match = re.match(
+            r'^(?:\s*WHERE\s+(.*?))?(?:\s+ORDER BY\s+(\S+)(?:\s+ASC)?)?'
+            r'(?:\s+LIMIT\s+(-?\d+))?\s*$', rest, re.I | re.S)
+        if match is None:
+            raise ValueError('Unsupported query %r.' % (text))
+        where, order_by, limit = match.groups()
+        tests = self.condition(where) if where else []
+        if target.lower() == 'metadata:indexmanager':
+            records = [self.describe_index(index)
+                       for index in self.database.indexes.itervalues()]
+            tests = []
+        elif target.startswith('('):
+            records = self.execute(target[1:-1])
+        elif target.startswith('['):
+            rids = [rid.strip() for rid in target[1:-1].split(',')]
+            records = [self.database.records[rid] for rid in rids
+                       if rid in self.database.records]
+        elif target.startswith('#'):
+            records = [self.database.records[target]] if (
+                target in self.database.records) else []
+        else:
+            index, records = self.find(target, tests)
+            if index is not None:
+                self.involved_indexes.append(index['name'])
+            tests = []
+        records = [r for r in records if self.matches(r, tests)]
+        if order_by:
+            records = sorted(records, key=lambda r: rid_key(r['@rid']))
+        if limit is not None and int(limit) >= 0:
+            records = records[:int(limit)]
+        if projection.lower() == 'expand(indexes)':
+            projection = ''
+        if projection:
+            records = [self.project(r, projection) for r in records]
+        return records
+
+    def neighbours(self, record, direction, edge_classes):
+        """Returns the @rids of the vertices joined to ``record`` by
+           edges of ``edge_classes`` (all edges if empty) in ``direction``.
+        """
+        result = []
+        for field, edges in record.items():
+            for prefix, end in (('out_', 'in'), ('in_', 'out')):
+                if not field.startswith(prefix):
+                    continue
+                if direction != 'BOTH' and prefix != direction.lower() + '_':
+                    continue
+                edge_class = field[len(prefix):]
+                if edge_classes and not any(
+                        edge_class in self.database.subclasses(name)
+                        for name in edge_classes):
+                    continue
+                for edge in edges:
+                    edge = self.database.records.get(edge)
+                    if edge is not None:
+                        result.append(edge[end])
+        return result
+
+    def targets(self, text):
+        """Returns the records named by a rid or a list of rids."""
+        text = text.strip()
+        if text.startswith('['):
+            rids = [rid.strip() for rid in text[1:-1].split(',')]
+        else:
+            rids = [text]
+        return [self.database.records[rid] for rid in rids
+                if rid in self.database.records]
+
+    def traverse(self, text):
+        """Breadth-first TRAVERSE through out(), in() or both(). The
+           depth of each record is kept for ``$depth`` conditions.
+        """
+        match = re.match(
+            r'^TRAVERSE (out|in|both)\(([^)]*)\) FROM (\[[^\]]*\]|\S+)'
+            r'(?: MAXDEPTH (\d+))?(?: STRATEGY BREADTH_FIRST)?$', text, re.I)
+        if match is None:
+            raise ValueError('Unsupported traversal %r.' % (text))
+        direction, edge_classes, target, max_depth = match.groups()
+        edge_classes = [name.strip().strip("'")
+                        for name in edge_classes.split(',') if name.strip()]
+        frontier = self.targets(target)
+        result = []
+        for record in frontier:
+            self.depths[record['@rid']] = 0
+        depth = 0
+        while frontier:
+            result.extend(frontier)
+            if max_depth is not None and depth >= int(max_depth):
+                break
+            depth += 1
+            next_frontier = []
+            for record in frontier:
+                for rid in self.neighbours(record, direction.upper(),
+                                           edge_classes):
+                    if rid not in self.depths:
+                        self.depths[rid] = depth
+                        next_frontier.append(self.database.records[rid])
+            frontier = next_frontier
+        return result
+
+    def shortest_path(self, arguments):
+        """Breadth-first shortestPath(source, target[, direction[,
+           edge class[, {"maxDepth": n}]]]).
+        """
+        match = re.match(
+            r"^(#\d+:\d+), (#\d+:\d+)(?:, '(\w+)')?"
+            r"(?:, (null|'\w+'))?(?:, (\{.*\}))?$", arguments.strip())
+        if match is None:
+            raise ValueError('Unsupported shortestPath %r.' % (arguments))
+        source, target, direction, edge_class, options = match.groups()
+        direction = (direction or 'BOTH').upper()
+        edge_classes = [edge_class.strip("'")] if (
+            edge_class and edge_class != 'null') else []
+        max_depth = json.loads(options).get('maxDepth') if options else None
+        parents = {source: None}
+        frontier = [source]
+        depth = 0
+        while frontier and target not in parents:
+            if max_depth is not None and depth >= max_depth:
+                break
+            depth += 1
+            next_frontier = []
+            for rid in frontier:
+                for neighbour in self.neighbours(
+                        self.database.records[rid], direction, edge_classes):
+                    if neighbour not in parents:
+                        parents[neighbour] = rid
+                        next_frontier.append(neighbour)
+            frontier = next_frontier
+        if target not in parents:
+            return []
+        path = [target]
+        while parents[path[-1]] is not None:
+            path.append(parents[path[-1]])
+        return [self.database.records[rid] for rid in reversed(path)]
+
+    def describe_index(self, index):
+        """Returns an index as the index manager describes it."""
+        definition = {'className': index['className']}
+        if len(index['fields']) == 1:
+            definition['field'] = index['fields'][0]
+        else:
+            definition['indexDefinitions'] = [
+                {'field': field} for field in index['fields']]
+        return {'@type': 'd', 'name': index['name'], 'type': index['type'],
+                'indexDefinition': definition}
+
+    def explain(self, text):
+        """Runs a query and describes how it was answered, the way
+           OrientDB 2.x does.
+        """
+        start = time.time()
+        records = self.execute(text)
+        plan = {'@type': 'd', 'elapsed': (time.time() - start) * 1000,
+                'resultType': 'collection', 'resultSize': len(records),
+                'fullySortedByIndex': False}
+        if self.involved_indexes:
+            plan['involvedIndexes'] = self.involved_indexes
+        return [plan]
+
+    def project(self, record, projection):
+        result = {'@type': 'd', '@rid': '#-2:0', '@version': 0}
+        for item in projection.split(','):
+            item = item.strip()
+            match = re.match(r'^(\S+)\s+AS\s+(\S+)$', item, re.I)
+            field, alias = match.groups() if match else (item, item)
+            result[alias.lstrip('@')] = (
+                record['@rid'] if field == '@rid' else get_path(record, field))
+        return result
+
+    def execute(self, text):
+        """Executes a statement and returns its result."""
+        text = text.strip()
+        word = text.split(None, 1)[0].upper()
+        match = re.match(r'^SELECT expand\(shortestPath\((.*)\)\)$', text,
+                         re.I | re.S)
+        if match:
+            return self.shortest_path(match.group(1))
+        if word == 'SELECT':
+            return self.select(text)
+        if word == 'EXPLAIN':
+            return self.explain(text.split(None, 1)[1])
+        if word == 'TRAVERSE':
+            return self.traverse(text)
+        match = re.match(r'^CREATE INDEX (\S+) ON (\w+) \(([^)]*)\) (\w+)$',
+                         text, re.I)
+        if match:
+            name, class_name, fields, index_type = match.groups()
+            self.database.create_index(
+                name, class_name, [f.strip() for f in fields.split(',')],
+                index_type)
+            return [{'value': len(self.database.indexes)}]
+        match = re.match(r'^DROP INDEX (\S+)$', text, re.I)
+        if match:
+            del self.database.indexes[match.group(1)]
+            return [{'value': 1}]
+        match = re.match(r'^REBUILD INDEX (\S+)$', text, re.I)
+        if match:
+            return [{'value': self.database.rebuild_index(match.group(1))}]
+        match = re.match(r'^CREATE CLASS (\w+)(?: EXTENDS (\w+))?$', text,
+                         re.I)
+        if match:
+            self.database.create_class(match.group(1), match.group(2))
+            return [{'value': len(self.database.classes)}]
+        match = re.match(r'^(?:INSERT INTO|CREATE VERTEX) (\w+)'
+                         r'(?: CONTENT (.*))?$', text, re.I | re.S)
+        if match:
+            content = json.loads(match.group(2) or '{}')
+            return [self.database.insert(match.group(1), content)]
+        match = re.match(r'^CREATE EDGE (\w+) FROM (\S+) TO (\S+)'
+                         r'(?: CONTENT (.*))?$', text, re.I | re.S)
+        if match:
+            content = json.loads(match.group(4) or '{}')
+            return [self.database.create_edge(
+                match.group(1), self.rid_of(match.group(2)),
+                self.rid_of(match.group(3)), content)]
+        match = re.match(r'^UPDATE (\S+) (CONTENT|MERGE) (.*?)'
+                         r'(?: (UPSERT))?(?: RETURN AFTER)?'
+                         r'(?: WHERE (.*))?$', text, re.I | re.S)
+        if match:
+            target, operator, content, upsert, where = match.groups()
+            content = json.loads(content)
+            merge = operator.upper() == 'MERGE'
+            if target.startswith('#') or target.startswith('$'):
+                rids = [self.rid_of(target)]
+            else:
+                _, records = self.find(
+                    target, self.condition(where) if where else [])
+                rids = [r['@rid'] for r in records]
+                if not rids and upsert:
+                    return [self.database.insert(target, content)]
+            return [self.database.update(rid, content, merge)
+                    for rid in rids]
+        match = re.match(r'^DELETE (?:VERTEX|EDGE|FROM) (\S+)$', text, re.I)
+        if match:
+            return [{'value': self.database.delete(
+                self.rid_of(match.group(1)))}]
+        raise ValueError('Unsupported statement %r.' % (text))
+
+    def script(self, lines):
+        """Executes a batch script of LET and RETURN statements."""
+        for line in lines:
+            match = re.match(r'^LET (\w+) = (.*)$', line, re.S)
+            if match:
+                self.variables[match.group(1)] = self.execute(match.group(2))
+                continue
+            match = re.match(r'^RETURN \[(.*)\]$', line, re.S)
+            if match:
+                return [self.variables[name.strip()[1:]]
+                        for name in match.group(1).split(',')
+                        if name.strip()]
+            self.execute(line)
+        return []
+
+
+class MockOrientDBHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Routes REST requests to the server's ``MockDatabase``."""
+    protocol_version = 'HTTP/1.1'
+    # responses are written as headers then body; without this, delayed
+    # ACKs add tens of milliseconds to every keep-alive request
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body, status=200, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Set-Cookie', 'OSESSIONID=mock; Path=/')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data, status=200):
+        self.send_body(json.dumps(data), status=status)
+
+    def handle_request(self, method):
+        time.sleep(self.server.latency)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+        parts = [urllib2.unquote(part) for part in
+                 self.path.split('?')[0].strip('/').split('/')]
+        try:
+            handler = getattr(self, 'route_' + parts[0].lower())
+        except AttributeError:
+            return self.send_json({'errors': ['not found']}, status=404)
+        try:
+            handler(method, parts[1:], body)
+        except (KeyError, ValueError, IndexError), e:
+            self.send_json({'errors': [repr(e)]}, status=500)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def route_connect(self, method, parts, body):
+        self.send_body('', status=204)
+
+    def route_listdatabases(self, method, parts, body):
+        self.send_json({'databases': [self.server.database_name]})
+
+    def route_command(self, method, parts, body):
+        database = self.server.database
+        if len(parts) > 2 and parts[2] != '-':
+            command, parameters = parts[2], None
+        else:
+            payload = json.loads(body)
+            command = payload['command']
+            parameters = payload.get('parameters')
+        result = Statement(database, parameters).execute(command)
+        if len(parts) > 3 and int(parts[3]) >= 0:
+            result = result[:int(parts[3])]
+        self.send_json({'result': result})
+
+    route_query = route_command
+
+    def route_batch(self, method, parts, body):
+        payload = json.loads(body)
+        result = None
+        with self.server.database.lock:
+            for operation in payload['operations']:
+                if operation['type'] == 'script':
+                    result = Statement(self.server.database).script(
+                        operation['script'])
+                elif operation['type'] == 'c':
+                    record = dict(operation['record'])
+                    result = self.server.database.insert(
+                        record.pop('@class'), record)
+        self.send_json({'result': result})
+
+    def route_document(self, method, parts, body):
+        database = self.server.database
+        if method == 'GET':
+            record = database.records.get('#' + parts[1].lstrip('#'))
+            if record is None:
+                return self.send_json({'errors': ['not found']}, status=404)
+            return self.send_json(record)
+        content = json.loads(body)
+        if len(parts) > 1:
+            record = database.update(
+                '#' + parts[1].lstrip('#'), content, merge=False)
+        else:
+            record = database.insert(content.pop('@class'), content)
+        self.send_json(record, status=201)
+
+    def route_property(self, method, parts, body):
+        cls = self.server.database.class_of(parts[1])
+        if parts[2] in cls['properties']:
+            raise ValueError('Property %s.%s already exists.' % (
+                cls['name'], parts[2]))
+        cls['properties'][parts[2]] = {
+            'name': parts[2], 'type': parts[3].upper()}
+        self.send_body('1', status=201, content_type='text/plain')
+
+    def route_class(self, method, parts, body):
+        cls = self.server.database.class_of(parts[1])
+        self.send_json(self.describe_class(cls))
+
+    def describe_class(self, cls):
+        return {
+            'name': cls['name'], 'superClass': cls['superClass'],
+            'clusters': [cls['cluster']],
+            'properties': cls['properties'].values()}
+
+    def route_database(self, method, parts, body):
+        self.send_json({
+            'server': {'version': 'mock'},
+            'classes': [self.describe_class(cls) for cls in
+                        self.server.database.classes.itervalues()]})
+
+    def route_export(self, method, parts, body):
+        database = self.server.database
+        export = {
+            'info': {'name': self.server.database_name},
+            'schema': {'classes': [
+                self.describe_class(cls)
+                for cls in database.classes.itervalues()]},
+            'records': sorted(database.records.itervalues(),
+                              key=lambda r: rid_key(r['@rid']))}
+        buffer = StringIO()
+        f = gzip.GzipFile(fileobj=buffer, mode='wb')
+        f.write(json.dumps(export))
+        f.close()
+        self.send_body(buffer.getvalue(),
+                       content_type='application/octet-stream')
+
+
+class MockOrientDBServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server holding one ``MockDatabase``. Every request is
+       delayed by ``latency`` seconds.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0,
+                 database_name='mock'):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, address, MockOrientDBHandler)
+        self.latency = latency
+        self.database_name = database_name
+        self.database = MockDatabase()
+
+    def handle_error(self, request, client_address):
+        # clients closing keep-alive connections aren't errors
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(
+                self, request, client_address)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        """Serves requests on a background thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def generate_graph(database, vertices, edges, vertex_class='node',
+                   edge_class='link', seed=0):
+    """Fills ``database`` with a random graph of ``vertices`` vertices with
+       a ``uri`` and a ``weight``, and ``edges`` edges between them.
+       Returns the list of vertex @rids.
+    """
+    rng = random.Random(seed)
+    database.create_class(vertex_class, 'V')
+    database.create_class(edge_class, 'E')
+    rids = [database.insert(vertex_class, {
+        'uri': '<http://example.org/%s/%d>' % (vertex_class, i),
+        'weight': rng.random()})['@rid'] for i in xrange(vertices)]
+    for i in xrange(edges):
+        database.create_edge(
+            edge_class, rng.choice(rids), rng.choice(rids),
+            {'uri': '<http://example.org/%s/%d>' % (edge_class, i)})
+    return rids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', type=int, default=2480)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--vertices', type=int, default=0)
+    parser.add_argument('--edges', type=int, default=0)
+    args = parser.parse_args()
+    server = MockOrientDBServer(('127.0.0.1', args.port),
+                                latency=args.latency)
+    if args.vertices:
+        generate_graph(server.database, args.vertices, args.edges)
+    print 'Mock OrientDB listening on port %d' % (server.port)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
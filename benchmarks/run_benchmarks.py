@@ -0,0 +1,448 @@
+"""Benchmarks for the py2orientdb client, run against the local mock
+server in ``mock_orientdb.py`` so they need no database. Each benchmark
+reports its throughput, the client-side latency of each operation, and
+the per-request metrics collected by the connection, as JSON:
+
+    python benchmarks/run_benchmarks.py --latency 0.001 --output out.json
+
+Results are only comparable between runs on the same machine with the
+same options. Each benchmark also checks what the calls it times
+returned, and the run fails if a result is wrong.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import py2orientdb
+import mock_orientdb
+
+BENCHMARKS = []
+
+
+def benchmark(f):
+    """Registers a benchmark function. It is called with the parsed
+       options and returns a list of results from ``measure``.
+    """
+    BENCHMARKS.append(f)
+    return f
+
+
+def check(name, actual, expected):
+    """Fails the run if a benchmark got ``actual`` instead of
+       ``expected``, so that a broken code path can't pass for a fast
+       one.
+    """
+    if actual != expected:
+        raise AssertionError('%s: expected %r, got %r.' % (
+            name, expected, actual))
+
+
+def connect(server, metric_hooks=None):
+    return py2orientdb.OrientDBConnection(
+        orientdb_address='http://127.0.0.1', orientdb_port=server.port,
+        user='root', password='root', database=server.database_name,
+        metric_hooks=metric_hooks)
+
+
+def start_server(options, vertices=0, edges=0):
+    """Starts a mock server with a fresh database, optionally holding a
+       synthetic graph. Returns the server and a list of vertex @rids.
+    """
+    server = mock_orientdb.MockOrientDBServer(
+        latency=options.latency).start()
+    rids = []
+    if vertices > 0:
+        rids = mock_orientdb.generate_graph(
+            server.database, vertices, edges, seed=options.seed)
+    return server, rids
+
+
+def measure(name, f, items, connection=None, ops=None):
+    """Calls ``f`` on each of ``items``, timing each call. Returns a
+       dictionary with the throughput in operations per second, where
+       the calls make up ``ops`` operations in all (one per item by
+       default), the latency of the calls, and the request metrics
+       recorded by ``connection``.
+    """
+    if connection is not None:
+        connection.metrics.reset()
+    latencies = []
+    start = time.time()
+    for item in items:
+        call_start = time.time()
+        f(item)
+        latencies.append(time.time() - call_start)
+    seconds = time.time() - start
+    latencies.sort()
+    if ops is None:
+        ops = len(latencies)
+    result = {
+        'name': name,
+        'ops': ops,
+        'seconds': seconds,
+        'ops_per_sec': ops / seconds if seconds > 0 else None,
+        'latency': {
+            'calls': len(latencies),
+            'mean': sum(latencies) / len(latencies) if latencies else None,
+            'p50': py2orientdb._percentile(latencies, 0.5),
+            'p90': py2orientdb._percentile(latencies, 0.9),
+            'p99': py2orientdb._percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else None}}
+    if connection is not None:
+        result['requests'] = connection.metrics.summary()
+    return result
+
+
+def random_document(rng, depth=2):
+    document = {}
+    for i in range(rng.randint(2, 6)):
+        key = 'field%d' % (i)
+        kind = rng.random()
+        if kind < 0.2 and depth > 0:
+            document[key] = random_document(rng, depth - 1)
+        elif kind < 0.6:
+            document[key] = 'value "%d"' % (rng.randint(0, 1000))
+        elif kind < 0.9:
+            document[key] = rng.randint(0, 1000000)
+        else:
+            document[key] = rng.random() < 0.5
+    return document
+
+
+@benchmark
+def where_clause(options):
+    """Builds WHERE clauses from nested documents, as literals and as
+       cached parameterized templates. No requests are made.
+    """
+    rng = random.Random(options.seed)
+    documents = [random_document(rng) for _ in xrange(options.documents)]
+    return [
+        measure('where_clause', py2orientdb.where_clause, documents),
+        measure('compile_where', py2orientdb.compile_where, documents)]
+
+
+@benchmark
+def select_from_paging(options):
+    """Reads a whole class through ``select_from`` with several page
+       sizes, with prefetching, without it, streamed and as ``Record``
+       objects. Each record read counts as one operation.
+    """
+    server, _ = start_server(options, vertices=options.vertices)
+    connection = connect(server)
+    results = []
+    try:
+        for page_size in (100, 1000):
+            for mode, kwargs in (
+                    ('prefetch', {'prefetch': True}),
+                    ('sequential', {'prefetch': False}),
+                    ('stream', {'stream': True}),
+                    ('records', {'as_records': True})):
+                name = 'select_from[page_size=%d,%s]' % (page_size, mode)
+                def read_all(_):
+                    rows = 0
+                    for _ in connection.select_from(
+                            'node', None, page_size=page_size, **kwargs):
+                        rows += 1
+                    check(name, rows, options.vertices)
+                results.append(measure(
+                    name, read_all, [None], connection=connection,
+                    ops=options.vertices))
+    finally:
+        connection.close()
+        server.stop()
+    return results
+
+
+@benchmark
+def get_document_fanout(options):
+    """Fetches a random sample of documents one request at a time with
+       ``get_document`` and in chunks with ``get_documents``.
+    """
+    server, rids = start_server(options, vertices=options.vertices)
+    connection = connect(server)
+    sample = random.Random(options.seed).sample(
+        rids, min(options.documents, len(rids)))
+    chunk = 100
+    chunks = [sample[i:i + chunk] for i in xrange(0, len(sample), chunk)]
+    def get_document(rid):
+        check('get_document', connection.get_document(rid)['@rid'], rid)
+    def get_documents(rids, **kwargs):
+        check('get_documents', [document['@rid'] for document in
+                                connection.get_documents(rids, **kwargs)],
+              rids)
+    try:
+        return [
+            measure('get_document', get_document, sample,
+                    connection=connection),
+            measure('get_documents[chunk_size=%d]' % (chunk),
+                    get_documents, chunks,
+                    connection=connection, ops=len(sample)),
+            measure('get_documents[concurrent]',
+                    lambda rids: get_documents(
+                        rids, chunk_size=chunk / 4, concurrent=True),
+                    chunks, connection=connection, ops=len(sample))]
+    finally:
+        connection.close()
+        server.stop()
+
+
+@benchmark
+def vertex_edge_creation(options):
+    """Creates vertices and edges one request at a time and through a
+       ``BatchWriter``.
+    """
+    server, _ = start_server(options)
+    connection = connect(server)
+    connection.create_vertex_class('node')
+    connection.create_edge_class('link')
+    n = options.documents
+    rng = random.Random(options.seed)
+    try:
+        results = [measure(
+            'create_vertex',
+            lambda i: connection.create_vertex(
+                'node', {'uri': 'single/%d' % (i)}),
+            xrange(n), connection=connection)]
+        rids = [r['@rid'] for r in connection.select_from('node', None)]
+        pairs = [(rng.choice(rids), rng.choice(rids)) for _ in xrange(n)]
+        results.append(measure(
+            'create_edge',
+            lambda pair: connection.create_edge(
+                pair[0], pair[1], subclass='link', content={'w': 1}),
+            pairs, connection=connection))
+        def batch_vertices(_):
+            with connection.batch() as batch:
+                for i in xrange(n):
+                    batch.create_vertex('node', {'uri': 'batch/%d' % (i)})
+        results.append(measure(
+            'batch.create_vertex', batch_vertices, [None],
+            connection=connection, ops=n))
+        def batch_edges(_):
+            with connection.batch() as batch:
+                for source, target in pairs:
+                    batch.create_edge(source, target, subclass='link',
+                                      content={'w': 1})
+        results.append(measure(
+            'batch.create_edge', batch_edges, [None],
+            connection=connection, ops=n))
+        results.append(measure(
+            'create_vertices',
+            lambda _: connection.create_vertices(
+                'node', [{'uri': 'bulk/%d' % (i)} for i in xrange(n)],
+                'uri'),
+            [None], connection=connection, ops=n))
+        check('vertices created', len(server.database.scan('node')), 3 * n)
+        check('edges created', len(server.database.scan('link')), 2 * n)
+        return results
+    finally:
+        connection.close()
+        server.stop()
+
+
+@benchmark
+def traversal(options):
+    """Expands 2-hop neighbourhoods client-side, with one ``neighbours``
+       request per frontier vertex, and on the server with ``k_hop``, and
+       finds shortest paths with ``shortest_path``.
+    """
+    vertices = min(options.vertices, 2000)
+    server, rids = start_server(options, vertices=vertices,
+                                edges=2 * vertices)
+    connection = connect(server)
+    rng = random.Random(options.seed)
+    starts = [rng.choice(rids) for _ in xrange(
+        min(options.documents, 50))]
+    def client_side(start):
+        seen = set([start])
+        frontier = [start]
+        for _ in range(2):
+            next_frontier = []
+            for rid in frontier:
+                for vertex in connection.neighbours(
+                        rid, 'out', 'link', page_size=None):
+                    if vertex['@rid'] not in seen:
+                        seen.add(vertex['@rid'])
+                        next_frontier.append(vertex['@rid'])
+            frontier = next_frontier
+        return seen
+    expected = {}
+    def server_side(start):
+        # the start vertex is the only one k_hop doesn't return
+        reached = set(vertex['@rid'] for vertex in connection.k_hop(
+            start, 2, 'out', 'link', page_size=None))
+        check('k_hop[k=2]', reached | set([start]), expected[start])
+    def client_side_expected(start):
+        expected[start] = client_side(start)
+    def shortest_path(start):
+        target = rng.choice(rids)
+        path = [vertex['@rid'] for vertex in connection.shortest_path(
+            start, target, 'out', 'link')]
+        if path:
+            check('shortest_path', (path[0], path[-1]), (start, target))
+    try:
+        return [
+            measure('k_hop[k=2,client_side]', client_side_expected,
+                    starts, connection=connection),
+            measure('k_hop[k=2]', server_side, starts,
+                    connection=connection),
+            measure('shortest_path', shortest_path, starts,
+                    connection=connection)]
+    finally:
+        connection.close()
+        server.stop()
+
+
+def write_ttl(file_name, triples, seed):
+    """Writes a gzip'd ttl file of ``triples`` random triples between
+       articles and categories. Returns the numbers of distinct articles
+       and categories in it.
+    """
+    rng = random.Random(seed)
+    articles = max(1, triples / 4)
+    categories = max(1, triples / 20)
+    used = (set(), set())
+    f = gzip.open(file_name, 'wb')
+    f.write('# generated by run_benchmarks.py\n')
+    for _ in xrange(triples):
+        article = rng.randint(0, articles)
+        category = rng.randint(0, categories)
+        used[0].add(article)
+        used[1].add(category)
+        f.write('<http://example.org/article/%d> '
+                '<http://purl.org/dc/terms/subject> '
+                '<http://example.org/category/%d> .\n' % (
+                article, category))
+    f.close()
+    return len(used[0]), len(used[1])
+
+
+def check_import(name, database, vertices, triples):
+    """Checks that an import of the file ``write_ttl`` wrote made one
+       vertex per article and category, and one edge per triple.
+    """
+    check(name, (len(database.scan('article')),
+                 len(database.scan('category')),
+                 len(database.scan('in_category'))),
+          vertices + (triples,))
+
+
+@benchmark
+def import_ttl(options):
+    """Imports a generated ttl file with ``import_ttl_file``, with one
+       worker and with several. Each triple counts as one operation. The
+       workers' requests are added to the main connection's metrics.
+    """
+    import import_ttl
+    directory = tempfile.mkdtemp()
+    file_name = os.path.join(directory, 'bench.ttl.gz')
+    vertices = write_ttl(file_name, options.triples, options.seed)
+    results = []
+    # import_ttl_file prints its summary, which must not end up in the
+    # JSON written to stdout
+    stdout = sys.stdout
+    try:
+        for workers in (1, 4):
+            server, _ = start_server(options)
+            connection = connect(server)
+            try:
+                sys.stdout = sys.stderr
+                name = 'import_ttl_file[workers=%d]' % (workers)
+                results.append(measure(
+                    name,
+                    lambda _: import_ttl.import_ttl_file(
+                        file_name, 'article', 'category', 'in_category',
+                        database_connection=connection,
+                        chunk_size=1000, workers=workers,
+                        connection_factory=lambda: connect(
+                            server, [connection.metrics.add])),
+                    [None], connection=connection,
+                    ops=options.triples))
+                check_import(name, server.database, vertices,
+                             options.triples)
+            finally:
+                sys.stdout = stdout
+                connection.close()
+                server.stop()
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+@benchmark
+def bulk_import(options):
+    """Loads the same kind of generated ttl file with ``BulkLoader``.
+       Each triple counts as one operation.
+    """
+    import bulk_import
+    directory = tempfile.mkdtemp()
+    file_name = os.path.join(directory, 'bench.ttl.gz')
+    vertices = write_ttl(file_name, options.triples, options.seed)
+    server, _ = start_server(options)
+    connection = connect(server)
+    try:
+        loader = bulk_import.BulkLoader(
+            connection, chunk_size=1000, progress=False,
+            checkpoint_file=os.path.join(directory, 'checkpoint'))
+        results = [measure(
+            'BulkLoader.load[ntriples]',
+            lambda _: loader.load(
+                file_name, bulk_import.read_ntriples,
+                source_class='article', target_class='category',
+                edge_class='in_category'),
+            [None], connection=connection, ops=options.triples)]
+        check_import('BulkLoader.load[ntriples]', server.database, vertices,
+                     options.triples)
+        return results
+    finally:
+        connection.close()
+        server.stop()
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the mock server waits per request')
+    parser.add_argument('--vertices', type=int, default=5000,
+                        help='size of the graph to page and fetch from')
+    parser.add_argument('--documents', type=int, default=500,
+                        help='number of single operations per benchmark')
+    parser.add_argument('--triples', type=int, default=5000,
+                        help='size of the generated ttl file')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', action='append', default=None,
+                        choices=[f.__name__ for f in BENCHMARKS],
+                        help='benchmark to run (repeatable)')
+    parser.add_argument('--output', default=None,
+                        help='file to write the JSON report to')
+    options = parser.parse_args()
+    report = {
+        'python': platform.python_version(),
+        'options': dict((k, v) for k, v in vars(options).iteritems()
+                        if k != 'output'),
+        'results': []}
+    for f in BENCHMARKS:
+        if options.only is None or f.__name__ in options.only:
+            sys.stderr.write('running %s\n' % (f.__name__))
+            report['results'].extend(f(options))
+    if options.output is None:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,515 @@
+"""Module for bulk loading graphs from N-Triples, CSV and edge list files.
+
+A reader turns the lines of a (plain, gzip'd or bzip2'd) file into
+``VertexRow`` and ``EdgeRow`` objects, and a ``BulkLoader`` writes them to
+the database a chunk at a time, recording its position in a checkpoint
+file after each chunk so an interrupted load can be resumed:
+
+    loader = BulkLoader(connection, checkpoint_file='load.checkpoint')
+    loader.load('article_categories_en.ttl.gz', read_ntriples,
+                source_class='article', target_class='category',
+                edge_class='in_category')
+"""
+
+import bz2
+import csv
+import io
+import json
+import os
+import re
+import zlib
+import progressbar
+
+DEFAULT_CHUNK_SIZE = 5000
+DEFAULT_READ_SIZE = 1024 * 1024
+
+
+class VertexRow(object):
+    """A vertex of ``class_name`` identified by ``key``, with optional
+       ``properties`` to set on it.
+    """
+    __slots__ = ('class_name', 'key', 'properties')
+
+    def __init__(self, class_name, key, properties=None):
+        self.class_name = class_name
+        self.key = key
+        self.properties = properties or {}
+
+
+class EdgeRow(object):
+    """An edge of ``class_name`` from the vertex ``source`` to the vertex
+       ``target``, each given as a (class name, key) pair.
+    """
+    __slots__ = ('class_name', 'source', 'target', 'properties')
+
+    def __init__(self, class_name, source, target, properties=None):
+        self.class_name = class_name
+        self.source = source
+        self.target = target
+        self.properties = properties or {}
+
+
+class _DecompressedStream(io.RawIOBase):
+    """Read-only stream of the decompressed contents of ``raw``. Files
+       made of several compressed members (e.g. by pbzip2) are read
+       through to the end.
+    """
+    def __init__(self, raw, make_decompressor):
+        self.raw = raw
+        self.make_decompressor = make_decompressor
+        self.decompressor = make_decompressor()
+        self.buffer = ''
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.position >= len(self.buffer):
+            data = self.raw.read(DEFAULT_READ_SIZE)
+            if len(data) == 0:
+                return 0
+            self.buffer = ''
+            self.position = 0
+            while data:
+                try:
+                    self.buffer += self.decompressor.decompress(data)
+                except EOFError:
+                    # the last member ended exactly at the end of the
+                    # previous read; zlib instead leaves data fed after
+                    # the end in unused_data
+                    self.decompressor = self.make_decompressor()
+                    continue
+                data = self.decompressor.unused_data
+                if data:
+                    self.decompressor = self.make_decompressor()
+        n = min(len(b), len(self.buffer) - self.position)
+        b[:n] = self.buffer[self.position:self.position + n]
+        self.position += n
+        return n
+
+
+class LineSource(object):
+    """Reads the lines of a file, decompressing '.gz' and '.bz2' files on
+       the fly. ``offset`` is the position in the decompressed data after
+       the last line read, so a load can be resumed from it with
+       ``seek``. ``header`` is the first line of the file.
+
+       Readers add to ``skipped`` for each line they can't parse.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.raw = open(file_name, 'rb')
+        if file_name.lower().endswith('.gz'):
+            self.f = io.BufferedReader(_DecompressedStream(
+                self.raw, lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)),
+                DEFAULT_READ_SIZE)
+        elif file_name.lower().endswith('.bz2'):
+            self.f = io.BufferedReader(_DecompressedStream(
+                self.raw, bz2.BZ2Decompressor), DEFAULT_READ_SIZE)
+        else:
+            self.f = self.raw
+        self.header = self.f.readline()
+        self.offset = len(self.header)
+        self.at_start = True
+        self.skipped = 0
+
+    def seek(self, offset):
+        """Moves to the decompressed ``offset``. Compressed files are
+           decompressed up to it, which is still much faster than writing
+           the records again.
+        """
+        self.at_start = False
+        if self.f is self.raw:
+            self.raw.seek(offset)
+            self.offset = offset
+            return
+        if offset < self.offset:
+            raise ValueError('Can only seek forward in a compressed file.')
+        while self.offset < offset:
+            data = self.f.read(min(DEFAULT_READ_SIZE, offset - self.offset))
+            if len(data) == 0:
+                break
+            self.offset += len(data)
+
+    def position(self):
+        """Position in the file on disk, for progress reporting."""
+        return self.raw.tell()
+
+    def lines(self, skip_header=False):
+        """Yields the lines from ``offset`` on. The header line is
+           included if reading from the start, unless ``skip_header``.
+        """
+        if self.at_start and not skip_header:
+            self.at_start = False
+            yield self.header
+        while True:
+            line = self.f.readline()
+            if len(line) == 0:
+                return
+            self.offset += len(line)
+            yield line
+
+    def close(self):
+        self.f.close()
+        self.raw.close()
+
+
+_NT_TERM = r'(<[^>]*>|_:\S+|"(?:[^"\\]|\\.)*"(?:@[\w-]+|\^\^<[^>]*>)?)'
+_NT_LINE = re.compile(
+    r'^\s*' + r'\s+'.join([_NT_TERM] * 3) + r'\s*\.\s*$')
+_NT_ESCAPE = re.compile(r'\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)')
+_NT_ESCAPES = {'t': '\t', 'n': '\n', 'r': '\r', 'b': '\b', 'f': '\f'}
+_XSD = '<http://www.w3.org/2001/XMLSchema#'
+_XSD_TYPES = {
+    _XSD + 'integer>': int, _XSD + 'int>': int, _XSD + 'long>': long,
+    _XSD + 'double>': float, _XSD + 'float>': float,
+    _XSD + 'decimal>': float, _XSD + 'boolean>': lambda v: v == 'true'}
+
+
+def _unescape(match):
+    escape = match.group(1)
+    if escape[0] in 'uU' and len(escape) > 1:
+        return unichr(int(escape[1:], 16))
+    return _NT_ESCAPES.get(escape, escape)
+
+
+def _literal(term):
+    """Returns the value of an N-Triples literal, converted to a number
+       or boolean for the common XML Schema datatypes.
+    """
+    end = term.rindex('"')
+    value = _NT_ESCAPE.sub(_unescape, term[1:end].decode('utf-8'))
+    suffix = term[end + 1:]
+    if suffix.startswith('^^') and suffix[2:] in _XSD_TYPES:
+        try:
+            return _XSD_TYPES[suffix[2:]](value)
+        except ValueError:
+            pass
+    return value
+
+
+def parse_ntriple(line):
+    """Parses one line of N-Triples into a (subject, predicate, object,
+       literal) tuple, where ``literal`` tells whether the object is a
+       literal. IRIs keep their angle brackets; literals are converted by
+       ``_literal``. Returns None for comments, blank lines and lines that
+       aren't valid N-Triples.
+    """
+    match = _NT_LINE.match(line)
+    if match is None:
+        return None
+    subject, predicate, obj = match.groups()
+    if predicate[0] != '<' or subject[0] == '"':
+        return None
+    if obj[0] == '"':
+        return subject, predicate, _literal(obj), True
+    return subject, predicate, obj, False
+
+
+def read_ntriples(source, source_class, target_class, edge_class='E',
+                  literal_properties=None):
+    """Reader for N-Triples files, and for TTL files that are written one
+       triple per line, as DBpedia's are. Turtle's @prefix, ';' and ','
+       shorthands aren't supported; such lines are skipped.
+
+       A triple between two resources becomes an edge from a
+       ``source_class`` vertex to a ``target_class`` vertex, storing the
+       predicate as the edge's 'uri'. ``edge_class`` is either one class
+       for all predicates, or a dictionary from predicate to class, in
+       which case triples with other predicates are skipped.
+
+       A triple whose object is a literal sets a property of the subject
+       if ``literal_properties`` maps its predicate to a property name,
+       and is skipped otherwise.
+    """
+    literal_properties = literal_properties or {}
+    for line in source.lines():
+        triple = parse_ntriple(line)
+        if triple is None:
+            if line.strip() and line.lstrip()[:1] != '#':
+                source.skipped += 1
+            continue
+        subject, predicate, obj, literal = triple
+        if literal:
+            if predicate in literal_properties:
+                yield VertexRow(source_class, subject,
+                                {literal_properties[predicate]: obj})
+            continue
+        if isinstance(edge_class, dict):
+            if predicate not in edge_class:
+                continue
+            class_name = edge_class[predicate]
+        else:
+            class_name = edge_class
+        yield EdgeRow(class_name, (source_class, subject),
+                      (target_class, obj), {'uri': predicate})
+
+
+def _csv_properties(row, columns, exclude, types):
+    properties = {}
+    for column, value in zip(columns, row):
+        if column in exclude or value == '':
+            continue
+        if column in types:
+            value = types[column](value)
+        properties[column] = value.decode('utf-8') if isinstance(
+            value, str) else value
+    return properties
+
+
+def read_csv_nodes(source, class_name, key_column, class_column=None,
+                   types=None, delimiter=','):
+    """Reader for CSV files of vertices, with a header line naming the
+       columns. ``key_column`` identifies each vertex, and the other
+       non-empty columns become its properties, converted by the
+       functions in ``types`` (e.g. ``{'age': int}``). The vertex class is
+       taken from ``class_column`` if given and not empty, and is
+       ``class_name`` otherwise.
+    """
+    types = types or {}
+    columns = next(csv.reader([source.header], delimiter=delimiter))
+    for row in csv.reader(source.lines(skip_header=True),
+                          delimiter=delimiter):
+        if len(row) != len(columns):
+            source.skipped += 1
+            continue
+        values = dict(zip(columns, row))
+        yield VertexRow(
+            values.get(class_column) or class_name,
+            values[key_column].decode('utf-8'),
+            _csv_properties(row, columns, (key_column, class_column), types))
+
+
+def read_csv_edges(source, edge_class, source_class, target_class,
+                   source_column='source', target_column='target',
+                   class_column=None, types=None, delimiter=','):
+    """Reader for CSV files of edges, with a header line naming the
+       columns. Each row is an edge from the ``source_class`` vertex whose
+       key is in ``source_column`` to the ``target_class`` vertex whose key
+       is in ``target_column``. Other columns become properties of the
+       edge, as for ``read_csv_nodes``, and ``class_column`` can override
+       ``edge_class``.
+    """
+    types = types or {}
+    columns = next(csv.reader([source.header], delimiter=delimiter))
+    exclude = (source_column, target_column, class_column)
+    for row in csv.reader(source.lines(skip_header=True),
+                          delimiter=delimiter):
+        if len(row) != len(columns):
+            source.skipped += 1
+            continue
+        values = dict(zip(columns, row))
+        yield EdgeRow(
+            values.get(class_column) or edge_class,
+            (source_class, values[source_column].decode('utf-8')),
+            (target_class, values[target_column].decode('utf-8')),
+            _csv_properties(row, columns, exclude, types))
+
+
+def read_edge_list(source, edge_class, vertex_class, delimiter=None):
+    """Reader for edge lists: one ``source target [weight]`` line per
+       edge, split on whitespace or ``delimiter``, between vertices of
+       ``vertex_class``. Lines starting with '#' or '%' are comments. A
+       third column is stored as the edge's 'weight'.
+    """
+    for line in source.lines():
+        if line.lstrip()[:1] in ('#', '%', ''):
+            continue
+        fields = line.strip().split(delimiter)
+        if len(fields) < 2:
+            source.skipped += 1
+            continue
+        properties = {}
+        if len(fields) > 2:
+            try:
+                properties['weight'] = float(fields[2])
+            except ValueError:
+                source.skipped += 1
+                continue
+        yield EdgeRow(edge_class, (vertex_class, fields[0].decode('utf-8')),
+                      (vertex_class, fields[1].decode('utf-8')), properties)
+
+
+class Checkpoint(object):
+    """Progress of loads, kept in the JSON file ``path``. One checkpoint
+       file can hold the state of any number of input files, each keyed
+       by its absolute path. The state of an input is ignored if the file
+       has changed size or modification time since it was saved.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.inputs = None
+
+    def _identity(self, file_name):
+        stat = os.stat(file_name)
+        return {'size': stat.st_size, 'mtime': int(stat.st_mtime)}
+
+    def _inputs(self):
+        """Returns the saved states by input path, reading the file once."""
+        if self.inputs is None:
+            self.inputs = {}
+            if os.path.exists(self.path):
+                with open(self.path) as f:
+                    saved = json.load(f)
+                if 'file' in saved:
+                    # written before checkpoints held several inputs
+                    saved = {'inputs': {saved.pop('file'): saved}}
+                self.inputs = saved.get('inputs', {})
+        return self.inputs
+
+    def load(self, file_name):
+        """Returns the saved state for ``file_name``, or None."""
+        if self.path is None:
+            return None
+        state = self._inputs().get(os.path.abspath(file_name))
+        if state is None:
+            return None
+        identity = self._identity(file_name)
+        if any(state.get(k) != v for k, v in identity.iteritems()):
+            return None
+        return state
+
+    def save(self, file_name, **state):
+        """Saves ``state`` for ``file_name``, keeping the states of the
+           other inputs. The file is replaced atomically, so a crash
+           never leaves a partial checkpoint.
+        """
+        if self.path is None:
+            return
+        state.update(self._identity(file_name))
+        inputs = self._inputs()
+        inputs[os.path.abspath(file_name)] = state
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump({'inputs': inputs}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temporary, self.path)
+
+
+class BulkLoader(object):
+    """Loads the rows produced by a reader into the database through
+       ``db_connection``, ``chunk_size`` rows at a time.
+
+       For each chunk, the vertices it mentions are looked up or created
+       with ``create_vertices``, keyed on the property ``key``, with any
+       properties from ``VertexRow`` objects merged in. The edges are then
+       created in one transactional batch. New classes get the ``key``
+       property and, with ``create_indexes``, a unique hash index on it.
+
+       After each chunk, the position in the input is saved to
+       ``checkpoint_file``, and ``load`` resumes from there. One checkpoint
+       file serves every input loaded through the loader. Vertex writes
+       are idempotent; only the edges of a chunk that was committed just
+       before a crash, but not checkpointed, can be written twice.
+    """
+    def __init__(self, db_connection, key='uri', chunk_size=DEFAULT_CHUNK_SIZE,
+                 checkpoint_file=None, create_indexes=True, progress=True):
+        self.db_connection = db_connection
+        self.key = key
+        self.chunk_size = chunk_size
+        self.checkpoint = Checkpoint(checkpoint_file)
+        self.create_indexes = create_indexes
+        self.progress = progress
+        self.classes = set()
+
+    def _ensure_class(self, class_name, vertex):
+        if class_name in self.classes:
+            return
+        if vertex:
+            self.db_connection.create_vertex_class(class_name)
+            self.db_connection.create_class_property(
+                self.key, class_name, 'string')
+            if self.create_indexes:
+                self.db_connection.ensure_index(
+                    class_name, self.key, index_type='UNIQUE_HASH_INDEX')
+        else:
+            self.db_connection.create_edge_class(class_name)
+        self.classes.add(class_name)
+
+    def _load_chunk(self, rows):
+        documents = {}
+        for row in rows:
+            if isinstance(row, VertexRow):
+                ends = [((row.class_name, row.key), row.properties)]
+            else:
+                ends = [(row.source, None), (row.target, None)]
+            for (class_name, key), properties in ends:
+                document = documents.setdefault(class_name, {}).setdefault(
+                    key, {self.key: key})
+                if properties:
+                    document.update(properties)
+        rids = {}
+        for class_name, by_key in documents.iteritems():
+            self._ensure_class(class_name, vertex=True)
+            keys = by_key.keys()
+            created = self.db_connection.create_vertices(
+                class_name, [by_key[key] for key in keys], self.key,
+                chunk_size=self.chunk_size, merge=True)
+            rids.update(((class_name, key), rid)
+                        for key, rid in zip(keys, created))
+        edges = [row for row in rows if isinstance(row, EdgeRow)]
+        for class_name in set(edge.class_name for edge in edges):
+            self._ensure_class(class_name, vertex=False)
+        if len(edges) > 0:
+            with self.db_connection.batch(
+                    batch_size=len(edges), transaction=True) as batch:
+                for edge in edges:
+                    batch.create_edge(
+                        rids[edge.source], rids[edge.target],
+                        subclass=edge.class_name,
+                        content=edge.properties or None)
+        return len(rows) - len(edges), len(edges)
+
+    def load(self, file_name, reader, **options):
+        """Loads ``file_name`` with ``reader`` (e.g. ``read_ntriples``),
+           which is called with a ``LineSource`` and ``options``. Resumes
+           from the checkpoint if there is one for this file. Returns a
+           dictionary of statistics about the load.
+        """
+        source = LineSource(file_name)
+        state = self.checkpoint.load(file_name) or {}
+        stats = {'rows': state.get('rows', 0), 'skipped': 0,
+                 'vertex_rows': 0, 'edge_rows': 0, 'chunks': 0,
+                 'resumed_from': state.get('offset', 0)}
+        if stats['resumed_from'] > 0:
+            source.seek(stats['resumed_from'])
+        pbar = None
+        if self.progress:
+            widgets = [
+                'Loading %s: ' % (os.path.basename(file_name)),
+                progressbar.Percentage(), ' ', progressbar.Bar('>'), ' ',
+                progressbar.ETA(' ')]
+            pbar = progressbar.ProgressBar(
+                widgets=widgets, maxval=os.path.getsize(file_name)).start()
+        try:
+            rows = []
+            for row in reader(source, **options):
+                rows.append(row)
+                if len(rows) >= self.chunk_size:
+                    self._commit(file_name, source, rows, stats, pbar)
+                    rows = []
+            self._commit(file_name, source, rows, stats, pbar)
+        finally:
+            source.close()
+        if pbar is not None:
+            pbar.finish()
+        stats['skipped'] = source.skipped
+        return stats
+
+    def _commit(self, file_name, source, rows, stats, pbar):
+        """Writes one chunk of rows and checkpoints the position after
+           it. The reader has consumed exactly the lines of these rows,
+           so ``source.offset`` is where the next chunk starts.
+        """
+        if len(rows) > 0:
+            vertex_rows, edge_rows = self._load_chunk(rows)
+            stats['vertex_rows'] += vertex_rows
+            stats['edge_rows'] += edge_rows
+            stats['rows'] += len(rows)
+            stats['chunks'] += 1
+        self.checkpoint.save(file_name, offset=source.offset,
+                             rows=stats['rows'])
+        if pbar is not None:
+            pbar.update(min(source.position(), pbar.maxval))
@@ -1,113 +1,357 @@
 """Module for importing compressed ttl files."""
 
 import gzip
+import os
+import threading
+import time
+import Queue
 import py2orientdb
 import progressbar
+import global_config as gc
 
 # assumes there is a graph database called "kb"
 # create database remote:localhost/kb root D5F8F36BB33B6B3171C7F479743E112235B0E475D4D3781ABF10705277419D55 plocal
 # connect remote:localhost/kb root D5F8F36BB33B6B3171C7F479743E112235B0E475D4D3781ABF10705277419D55
-# orientdb {kb}> CREATE INDEX article_uri ON article (uri) dictionary_hash_index
-# add index creation to py2orientdb as a generic post command
+# the unique indexes on uri are created by import_ttl_file (create_indexes)
 
-def import_ttl_file(file_name, source_class, target_class, edge_class, test_only=False):
-    database_connection = py2orientdb.OrientDBConnection(
-        orientdb_address='http://localhost', orientdb_port=2480,
-        user='root', password=gc.PASSWORD, database='kb')
-    print 'getting number of lines...'
-    f = gzip.open(file_name, 'r')
-    total_lines = 0
-    for line in f:
-        total_lines += 1
-    f.close()
-    print 'done...'
-    widgets = [
-        'Getting vertices: ', progressbar.Percentage(), ' ',
-        progressbar.Bar('>'), ' ',
-        progressbar.ETA(' ')]
-    pbar = progressbar.ProgressBar(widgets=widgets, maxval=total_lines).start()
-    f = gzip.open(file_name, 'r')
+DEFAULT_CHUNK_SIZE = 5000
+DEFAULT_MAX_RETRIES = 3
+TEST_ONLY_LINES = 10000
+
+
+def iter_triples(f, max_lines=None):
+    """Lazily parses the lines of an open ttl file, yielding a
+       (source, edge, target) tuple for each triple. Comments and lines
+       that don't have the form ``<source> <edge> <target> .`` are
+       skipped.
+    """
     counter = 0
-    source_set = set([])
-    target_set = set([])
     for line in f:
         counter += 1
-        if line[0] == '#':
-            continue
-        if test_only and counter > 10000:
+        if max_lines is not None and counter > max_lines:
             break
-        source, edge, target, _ = line.split()
-        source_set.add(source)
-        target_set.add(target)
-        if counter % 100 == 0:
-            pbar.update(counter)
-    f.close()
-    pbar.finish()
-    counter = 0
+        if line[:1] == '#':
+            continue
+        fields = line.split()
+        if len(fields) != 4:
+            continue
+        source, edge, target, _ = fields
+        yield source, edge, target
+
+
+def iter_chunks(iterable, chunk_size):
+    """Groups the items of ``iterable`` into lists of at most
+       ``chunk_size`` items, without reading ahead any further.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def _uris_by_class(triples, source_class, target_class):
+    """Returns a dictionary of the set of URIs to create in each class,
+       which is a single set when the source and target classes are the
+       same.
+    """
+    uris = {source_class: set(), target_class: set()}
+    for source, _, target in triples:
+        uris[source_class].add(source)
+        uris[target_class].add(target)
+    return uris
+
+
+def _import_chunk(database_connection, triples, source_class, target_class,
+                  edge_class, chunk_size):
+    """Creates the vertices and edges for one chunk of triples. Vertices
+       are created with ``create_vertices``, which skips the URIs that
+       exist already, so a re-import only costs a few requests per chunk.
+       URIs are resolved through the connection's rid cache.
+    """
+    vertices = {}
+    for graph_class, uris in _uris_by_class(
+            triples, source_class, target_class).iteritems():
+        uris = list(uris)
+        rids = database_connection.create_vertices(
+            graph_class, [{'uri': uri} for uri in uris], 'uri',
+            chunk_size=chunk_size)
+        vertices[graph_class] = dict(zip(uris, rids))
+    with database_connection.batch(batch_size=chunk_size) as batch:
+        for source, edge, target in triples:
+            batch.create_edge(
+                vertices[source_class][source],
+                vertices[target_class][target],
+                subclass=edge_class, content={'uri': edge})
+
+
+class RateLimiter(object):
+    """Token bucket shared by the import workers. ``acquire(n)`` blocks
+       until ``n`` records may be sent without exceeding ``rate`` records
+       per second.
+    """
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.allowance = self.rate
+        self.last_check = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self, n=1):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.allowance = min(
+                    self.rate,
+                    self.allowance + (now - self.last_check) * self.rate)
+                self.last_check = now
+                if self.allowance >= min(n, self.rate):
+                    self.allowance -= n
+                    return
+                wait = (min(n, self.rate) - self.allowance) / self.rate
+            time.sleep(wait)
+
+
+class WorkerPool(object):
+    """Pool of threads that each own one pooled connection, made by
+       ``connection_factory``. All the connections share ``rid_cache``.
+
+       ``run(tasks)`` calls each task with a worker's connection and
+       returns the results in order. A task that raises is retried up to
+       ``max_retries`` times with exponential backoff; if it still fails
+       its result is None and the error is appended to ``failures``
+       instead of stopping the import.
+    """
+    def __init__(self, workers, connection_factory, rid_cache,
+                 rate_limiter=None, max_retries=DEFAULT_MAX_RETRIES):
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.failures = []
+        self.tasks = Queue.Queue()
+        self.threads = []
+        try:
+            for _ in range(workers):
+                connection = connection_factory()
+                connection.rid_cache = rid_cache
+                thread = threading.Thread(
+                    target=self._work, args=(connection,))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        except Exception:
+            self.close()
+            raise
+
+    def _work(self, connection):
+        try:
+            while True:
+                item = self.tasks.get()
+                if item is None:
+                    self.tasks.task_done()
+                    break
+                self._run_task(connection, *item)
+        finally:
+            connection.close()
+
+    def _run_task(self, connection, task, size, results, index):
+        try:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(size)
+            for attempt in range(self.max_retries + 1):
+                try:
+                    results[index] = task(connection)
+                    break
+                except Exception as e:
+                    if attempt == self.max_retries:
+                        self.failures.append(e)
+                    else:
+                        time.sleep(0.5 * 2 ** attempt)
+        finally:
+            self.tasks.task_done()
+
+    def close(self):
+        """Stops the threads once the queued tasks are done, and closes
+           their connections.
+        """
+        for _ in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def run(self, tasks):
+        """Runs a list of (task, size) pairs, where ``size`` is the number
+           of records the task writes, and waits for all of them.
+        """
+        results = [None] * len(tasks)
+        for index, (task, size) in enumerate(tasks):
+            self.tasks.put((task, size, results, index))
+        self.tasks.join()
+        return results
+
+
+def _vertex_task(graph_class, uris, chunk_size):
+    def task(database_connection):
+        return database_connection.create_vertices(
+            graph_class, [{'uri': uri} for uri in uris], 'uri',
+            chunk_size=chunk_size)
+    return task
+
+
+def _edge_task(edges, edge_class, chunk_size):
+    def task(database_connection):
+        # a transaction makes a retried chunk all-or-nothing
+        with database_connection.batch(
+                batch_size=chunk_size, transaction=True) as batch:
+            for source_rid, edge, target_rid in edges:
+                batch.create_edge(source_rid, target_rid,
+                                  subclass=edge_class, content={'uri': edge})
+    return task
+
+
+def _import_chunk_parallel(pool, workers, triples, source_class,
+                           target_class, edge_class, chunk_size):
+    """Parallel version of ``_import_chunk``. Vertex creation is sharded
+       across the workers by the hash of the URI, so that two workers
+       never race to create the same vertex. Edges are created once all
+       of the chunk's vertices exist. Triples whose vertices could not be
+       created are skipped and counted as failures.
+    """
+    shards = []
+    for graph_class, uris in _uris_by_class(
+            triples, source_class, target_class).iteritems():
+        buckets = [[] for _ in range(workers)]
+        for uri in uris:
+            buckets[hash(uri) % workers].append(uri)
+        shards.extend((graph_class, bucket) for bucket in buckets if bucket)
+    results = pool.run([
+        (_vertex_task(graph_class, uris, chunk_size), len(uris))
+        for graph_class, uris in shards])
+    vertices = {source_class: {}, target_class: {}}
+    for (graph_class, uris), rids in zip(shards, results):
+        if rids is not None:
+            vertices[graph_class].update(zip(uris, rids))
+    edges = []
+    for source, edge, target in triples:
+        source_rid = vertices[source_class].get(source)
+        target_rid = vertices[target_class].get(target)
+        if source_rid is None or target_rid is None:
+            pool.failures.append(
+                'no vertex for triple %s %s %s' % (source, edge, target))
+            continue
+        edges.append((source_rid, edge, target_rid))
+    slice_size = max(1, -(-len(edges) // workers))
+    pool.run([
+        (_edge_task(edges[i:i + slice_size], edge_class, chunk_size),
+         len(edges[i:i + slice_size]))
+        for i in range(0, len(edges), slice_size)])
+
+
+def _default_connection():
+    return py2orientdb.OrientDBConnection(
+        orientdb_address='http://localhost', orientdb_port=2480,
+        user='root', password=gc.PASSWORD, database='kb')
+
+
+def _connection_like(database_connection):
+    """Returns a function making new connections to the same server and
+       database, as the same user, as ``database_connection``.
+    """
+    def connect():
+        return py2orientdb.OrientDBConnection(
+            orientdb_address=database_connection.orientdb_address,
+            orientdb_port=database_connection.orientdb_port,
+            user=database_connection.user,
+            password=database_connection.password,
+            database=database_connection.database,
+            pool_size=database_connection.pool_size,
+            max_retries=database_connection.max_retries,
+            backoff_factor=database_connection.backoff_factor)
+    return connect
+
+
+def import_ttl_file(file_name, source_class, target_class, edge_class,
+                    test_only=False, database_connection=None,
+                    chunk_size=DEFAULT_CHUNK_SIZE, workers=1,
+                    connection_factory=None, rate_limit=None,
+                    max_retries=DEFAULT_MAX_RETRIES, create_indexes=True):
+    """Imports a gzip'd ttl file in a single streaming pass. Triples are
+       read lazily and handed to the database ``chunk_size`` at a time, so
+       memory use depends on the chunk size and not on the size of the
+       file. Progress is measured by the position in the compressed file.
+
+       URI lookups go through the connection's rid cache; give the
+       connection a ``py2orientdb.SqliteRidCache`` for dumps with more
+       URIs than fit in memory. The cache's hit/miss counts are printed
+       at the end.
+
+       With ``workers`` > 1, each chunk is written by a pool of threads
+       that each own a connection made by ``connection_factory``, or,
+       by default, to the same database as ``database_connection``.
+       ``rate_limit`` caps the number of records written per second
+       across all workers. Failed writes are retried ``max_retries``
+       times and then reported at the end instead of stopping the run.
+
+       With ``create_indexes``, a unique hash index on ``uri`` is created
+       for the source and target classes before importing (unless they
+       have one), so that URI lookups don't scan the whole class.
+    """
+    if connection_factory is None:
+        if database_connection is None:
+            connection_factory = _default_connection
+        else:
+            connection_factory = _connection_like(database_connection)
+    if database_connection is None:
+        database_connection = connection_factory()
+    # classes and properties that exist already are skipped
     database_connection.create_vertex_class(source_class)
     database_connection.create_vertex_class(target_class)
     database_connection.create_edge_class(edge_class)
     database_connection.create_class_property('uri', source_class, 'string')
     database_connection.create_class_property('uri', target_class, 'string')
     database_connection.create_class_property('uri', edge_class, 'string')
+    if create_indexes:
+        for graph_class in (source_class, target_class):
+            database_connection.ensure_index(
+                graph_class, 'uri', index_type='UNIQUE_HASH_INDEX')
     widgets = [
-        'Creating source vertices: ', progressbar.Percentage(), ' ',
+        'Importing triples: ', progressbar.Percentage(), ' ',
         progressbar.Bar('>'), ' ',
         progressbar.ETA(' ')]
-    pbar = progressbar.ProgressBar(widgets=widgets, maxval=len(source_set)).start()
-    for source in source_set:
-        counter += 1
-        if counter % 100 == 0:
-            pbar.update(counter)
-        d = {'uri': source}
-        if len(list(database_connection.check_exists(source_class, d))) > 0:
-            pass # we already have the vertex
-        else:
-            database_connection.create_vertex(subclass=source_class, content=d)
-    pbar.finish()
-    counter = 0
-    widgets = [
-        'Creating target vertices: ', progressbar.Percentage(), ' ',
-        progressbar.Bar('>'), ' ',
-        progressbar.ETA(' ')]
-    pbar = progressbar.ProgressBar(widgets=widgets, maxval=len(target_set)).start()
-    for target in target_set:
-        counter += 1
-        if counter % 100 == 0:
-            pbar.update(counter)
-        d = {'uri': target}
-        if len(list(database_connection.check_exists(target_class, d))) > 0:
-            pass
-        else:
-            database_connection.create_vertex(subclass=target_class, content=d)
-    pbar.finish()
-    f = gzip.open(file_name, 'r')
-    counter = 0
-    widgets = [
-        'Creating edges: ', progressbar.Percentage(), ' ',
-        progressbar.Bar('>'), ' ',
-        progressbar.ETA(' ')]
-    pbar = progressbar.ProgressBar(widgets=widgets, maxval=total_lines).start()
-    for line in f:
-        counter += 1
-        if counter % 100 == 0:
-            pbar.update(counter)
-        if line[0] == '#':
-            continue
-        source, edge, target, _ = line.split()
-        try:
-            source_rid = list(database_connection.select_from(
-                source_class, {'uri': source}))[0]['@rid']
-            target_rid = list(database_connection.select_from(
-                target_class, {'uri': target}))[0]['@rid']
-        except:
-            pass
-        database_connection.create_edge(
-            source_rid, target_rid, subclass=edge_class,
-            content={'uri': edge})
+    raw_file = open(file_name, 'rb')
+    pbar = progressbar.ProgressBar(
+        widgets=widgets, maxval=os.path.getsize(file_name)).start()
+    f = gzip.GzipFile(fileobj=raw_file, mode='rb')
+    max_lines = TEST_ONLY_LINES if test_only else None
+    pool = None
+    if workers > 1:
+        rate_limiter = None
+        if rate_limit is not None:
+            rate_limiter = RateLimiter(rate_limit)
+        pool = WorkerPool(
+            workers, connection_factory, database_connection.rid_cache,
+            rate_limiter=rate_limiter, max_retries=max_retries)
+    try:
+        for triples in iter_chunks(iter_triples(f, max_lines), chunk_size):
+            if pool is None:
+                _import_chunk(database_connection, triples, source_class,
+                              target_class, edge_class, chunk_size)
+            else:
+                _import_chunk_parallel(pool, workers, triples, source_class,
+                                       target_class, edge_class, chunk_size)
+            pbar.update(raw_file.tell())
+    finally:
+        if pool is not None:
+            pool.close()
+        f.close()
+        raw_file.close()
     pbar.finish()
+    print 'rid cache:', database_connection.rid_cache.stats()
+    if pool is not None and len(pool.failures) > 0:
+        print '%d failures, first: %s' % (
+            len(pool.failures), pool.failures[0])
 
 if __name__ == '__main__':
-    import global_config as gc
     import_ttl_file(gc.ARTICLE_CATEGORIES_FILE, 'article', 'category', 'in_category', test_only=False)
-
@@ -5,12 +5,21 @@ the Tinkerpop stack, and just uses the SQL-like language for OrientDB.
 """
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 import urllib2
+import functools
 import gzip
-from StringIO import StringIO
+import zlib
 import global_config as gc # where I keep my passwords, etc.
 import json
-import copy
+import re
+import sys
+import threading
+import time
+import random
+from collections import OrderedDict
+from itertools import imap
 
 
 class AuthenticationError(Exception):
@@ -34,11 +43,243 @@ class OrientDBResponseError(Exception):
         return repr(self.value)
 
 
+class RecordNotFoundError(Exception):
+    """Error when one or more of the requested records don't exist.
+       ``value`` is the list of the missing record ids.
+    """
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_RID_CACHE_SIZE = 100000
+DEFAULT_DOCUMENT_CACHE_SIZE = 10000
+DEFAULT_STREAM_CHUNK_SIZE = 64 * 1024
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+RETRY_STATUS_CODES = (502, 503, 504)
+INDEX_TYPES = (
+    'UNIQUE', 'NOTUNIQUE', 'FULLTEXT', 'DICTIONARY', 'UNIQUE_HASH_INDEX',
+    'NOTUNIQUE_HASH_INDEX', 'FULLTEXT_HASH_INDEX', 'DICTIONARY_HASH_INDEX')
+DEFAULT_INDEX_TYPE = 'UNIQUE_HASH_INDEX'
+DIRECTIONS = ('out', 'in', 'both')
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+DATE_FORMAT = '%Y-%m-%d'
+
+
+def _make_session(pool_size=DEFAULT_POOL_SIZE, max_retries=DEFAULT_MAX_RETRIES,
+                  backoff_factor=DEFAULT_BACKOFF_FACTOR, retry_post=False):
+    """Returns a ``requests.Session`` whose connections are kept alive and
+       pooled, so that repeated calls to the server reuse the same TCP
+       connections instead of opening a new one per request.
+
+       Transient failures (connection errors and 502/503/504 responses)
+       are retried ``max_retries`` times with exponential backoff. Only
+       idempotent methods are retried on a read error or a bad status, so
+       a POST that may have reached the server is never silently re-sent.
+       Set ``retry_post`` for a session that only POSTs read-only queries.
+    """
+    methods = (getattr(Retry, 'DEFAULT_ALLOWED_METHODS', None) or
+               Retry.DEFAULT_METHOD_WHITELIST)
+    if retry_post:
+        methods = methods | frozenset(['POST'])
+    options = dict(
+        total=max_retries, connect=max_retries, read=max_retries,
+        status=max_retries, backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUS_CODES, raise_on_status=False)
+    try:
+        retry = Retry(allowed_methods=methods, **options)
+    except TypeError:
+        # urllib3 before 1.26
+        retry = Retry(method_whitelist=methods, **options)
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size,
+        max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({'Connection': 'keep-alive'})
+    return session
+
+
+METRICS_SAMPLE_SIZE = 10000
+
+
+class RequestMetric(object):
+    """Timings and sizes of one request to the server. Times are in
+       seconds:
+
+       ``wait``: from sending the request until the response headers
+       arrived, which covers opening a connection (if the pool had none
+       free) and the server's work. ``transfer``: reading the response
+       body. ``decode``: parsing the JSON. For streamed results the body
+       is parsed as it is read, so ``decode`` is included in ``transfer``.
+
+       ``operation`` is one of 'connect', 'query', 'command', 'document',
+       'batch', 'schema', 'export' or 'server'. ``rows`` is the number of
+       results decoded, or None if the response wasn't decoded.
+       ``status`` is the response's status code, or the name of the
+       exception raised if no response arrived (e.g. 'ConnectionError'),
+       in which case ``wait`` is the time until it was raised.
+    """
+    def __init__(self, operation, method, url, status, wait, transfer,
+                 request_bytes, response_bytes):
+        self.operation = operation
+        self.method = method
+        self.url = url
+        self.status = status
+        self.wait = wait
+        self.transfer = transfer
+        self.decode = 0.0
+        self.request_bytes = request_bytes
+        self.response_bytes = response_bytes
+        self.rows = None
+
+    @property
+    def latency(self):
+        return self.wait + self.transfer + self.decode
+
+    def to_dict(self):
+        d = dict(self.__dict__)
+        d['latency'] = self.latency
+        return d
+
+
+def _percentile(values, fraction):
+    """Returns the ``fraction`` percentile of the sorted list ``values``."""
+    if len(values) == 0:
+        return None
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+
+class MetricsSummary(object):
+    """In-process aggregate of ``RequestMetric`` objects by operation.
+       Counts, totals and maximum latencies are exact. Percentiles are
+       computed from a uniform random sample of at most ``sample_size``
+       latencies per operation, so memory stays bounded during long runs.
+    """
+    def __init__(self, sample_size=METRICS_SAMPLE_SIZE):
+        self.sample_size = sample_size
+        self.operations = {}
+        self.lock = threading.Lock()
+
+    def add(self, metric):
+        with self.lock:
+            totals = self.operations.get(metric.operation)
+            if totals is None:
+                totals = self.operations[metric.operation] = {
+                    'count': 0, 'errors': 0, 'rows': 0, 'wait': 0.0,
+                    'transfer': 0.0, 'decode': 0.0, 'request_bytes': 0,
+                    'response_bytes': 0, 'max': None, 'latencies': []}
+            totals['count'] += 1
+            if str(metric.status)[0] != '2':
+                totals['errors'] += 1
+            totals['rows'] += metric.rows or 0
+            for name in ('wait', 'transfer', 'decode', 'request_bytes',
+                         'response_bytes'):
+                totals[name] += getattr(metric, name)
+            totals['max'] = max(totals['max'], metric.latency)
+            latencies = totals['latencies']
+            if len(latencies) < self.sample_size:
+                latencies.append(metric.latency)
+            else:
+                index = random.randint(0, totals['count'] - 1)
+                if index < self.sample_size:
+                    latencies[index] = metric.latency
+
+    def summary(self):
+        """Returns a dictionary of statistics by operation, with the
+           p50/p90/p99 and maximum latencies.
+        """
+        with self.lock:
+            summary = {}
+            for operation, totals in self.operations.iteritems():
+                d = dict((k, v) for k, v in totals.iteritems()
+                         if k != 'latencies')
+                latencies = sorted(totals['latencies'])
+                d['p50'] = _percentile(latencies, 0.5)
+                d['p90'] = _percentile(latencies, 0.9)
+                d['p99'] = _percentile(latencies, 0.99)
+                summary[operation] = d
+            return summary
+
+    def dump(self, f):
+        """Writes the summary to the file object ``f`` as JSON."""
+        json.dump(self.summary(), f, indent=2, sort_keys=True)
+        f.write('\n')
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+
+
+class RID(object):
+    """Record id parsed into its integer ``cluster`` and ``position``.
+       RIDs compare and hash like their '#<cluster>:<position>' strings,
+       so they can be mixed with string ids in sets and dictionary keys,
+       and they sort in @rid order.
+    """
+    __slots__ = ('cluster', 'position')
+
+    def __init__(self, cluster, position):
+        self.cluster = cluster
+        self.position = position
+
+    @classmethod
+    def parse(cls, rid):
+        """Returns ``rid`` (a string with or without '#', a (cluster,
+           position) pair or a RID) as a RID.
+        """
+        if isinstance(rid, RID):
+            return rid
+        return cls(*_rid_key(rid))
+
+    def __str__(self):
+        return '#%d:%d' % (self.cluster, self.position)
+
+    def __repr__(self):
+        return 'RID(%r)' % (str(self))
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __eq__(self, other):
+        if isinstance(other, basestring):
+            return str(self) == _rid_format(other)
+        if isinstance(other, RID):
+            return (self.cluster == other.cluster and
+                    self.position == other.position)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __lt__(self, other):
+        return _rid_key(self) < _rid_key(other)
+
+    def __le__(self, other):
+        return _rid_key(self) <= _rid_key(other)
+
+    def __gt__(self, other):
+        return _rid_key(self) > _rid_key(other)
+
+    def __ge__(self, other):
+        return _rid_key(self) >= _rid_key(other)
+
+
 def _rid_format(rid):
     """Converts the ``rid`` as specified into a string of the form:
        #<cluster>:<id>.
     """
-    if isinstance(rid, str):
+    if isinstance(rid, RID):
+        return str(rid)
+    if isinstance(rid, basestring):
         if rid[0] == '#':
             return rid
         else:
@@ -48,28 +289,437 @@ def _rid_format(rid):
     if isinstance(rid, tuple):
         if len(rid) != 2:
             raise Exception('rid is an iterable of length != 2')
-        rid = '#' + ':'.join(str(rid[0]), str(rid[1]))
+        rid = '#' + ':'.join([str(rid[0]), str(rid[1])])
         return rid
     raise Exception('rid is not a recognized format')
 
 
-def _paginate(f, *args):
-    """Decorator for mimicking a cursor object. OrientDB does not have
-       cursor objects for paging through results. This decorator can be
-       wrapped around a function which returns one set of results.
-       It will cause the function to be executed repeatedly, skipping the
-       number of documents that have been yielded already. The function
-       decorated must have a 'skip=0' default argument.
-    """
-    def inner_function(*args):
-        counter = 0
-        results = f(*args, skip=counter)
-        while len(results) > 0:
-            for result in results:
-                yield result
-                counter += 1
-            results = f(*args, skip=counter)
-    return inner_function
+def _rid_key(rid):
+    """Returns ``rid`` as a (cluster, position) tuple of ints."""
+    if isinstance(rid, RID):
+        return rid.cluster, rid.position
+    cluster, position = _rid_format(rid)[1:].split(':')
+    return int(cluster), int(position)
+
+
+MAX_RECORD_LAYOUTS = 1024
+_record_layouts = {}
+
+
+class _RecordLayout(object):
+    """The interned property names of a shape of record, and their
+       positions. Records with the same properties share one layout.
+    """
+    __slots__ = ('fields', 'positions')
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.positions = dict((field, i) for i, field in enumerate(fields))
+
+
+def _intern(name):
+    if isinstance(name, unicode):
+        try:
+            name = name.encode('ascii')
+        except UnicodeEncodeError:
+            return name
+    return intern(name)
+
+
+def _record_layout(names):
+    """Returns the shared ``_RecordLayout`` for the tuple ``names``."""
+    layout = _record_layouts.get(names)
+    if layout is None:
+        layout = _RecordLayout(tuple(_intern(name) for name in names))
+        if len(_record_layouts) >= MAX_RECORD_LAYOUTS:
+            _record_layouts.clear()
+        _record_layouts[names] = layout
+    return layout
+
+
+def _decode_field(value, field_type):
+    """Converts a property value sent as JSON to the Python type given by
+       its OrientDB ``@fieldTypes`` code. Unknown codes and values that
+       don't parse are returned as they are.
+    """
+    if value is None:
+        return None
+    if field_type == 'l':
+        return long(value)
+    if field_type == 'c':
+        import decimal
+        return decimal.Decimal(str(value))
+    if field_type == 'b':
+        import base64
+        return base64.b64decode(value)
+    if field_type in ('t', 'a'):
+        import datetime
+        formats = {'t': DATETIME_FORMAT, 'a': DATE_FORMAT}
+        try:
+            parsed = datetime.datetime.strptime(value, formats[field_type])
+        except (TypeError, ValueError):
+            return value
+        return parsed.date() if field_type == 'a' else parsed
+    if field_type in ('x', 'z', 'n', 'g'):
+        if isinstance(value, basestring):
+            return RID.parse(value)
+        if isinstance(value, list):
+            return [RID.parse(v) if isinstance(v, basestring) else v
+                    for v in value]
+        if isinstance(value, dict):
+            return dict((k, RID.parse(v) if isinstance(v, basestring) else v)
+                        for k, v in value.iteritems())
+    return value
+
+
+_INTEGER_TYPES = ('BYTE', 'SHORT', 'INTEGER', 'LONG')
+_FLOAT_TYPES = ('FLOAT', 'DOUBLE')
+_LINK_TYPES = ('LINK', 'LINKLIST', 'LINKSET', 'LINKMAP')
+_PLAIN_TYPES = (basestring, bool, int, long, float)
+
+
+def _encode_link(value):
+    if isinstance(value, Record):
+        return str(value.rid)
+    if isinstance(value, RID) or (isinstance(value, basestring) and value):
+        return _rid_format(value)
+    return value
+
+
+def _encode_value(value, property_type=None):
+    """Converts a property value to the JSON form OrientDB expects for a
+       property of type ``property_type`` ('LONG', 'DATETIME', ...) or,
+       if the type isn't known, for the Python type of ``value``. Links
+       become record ids and dates and decimals become strings. Values
+       that don't convert are returned as they are.
+    """
+    if value is None:
+        return None
+    if property_type is None and isinstance(value, _PLAIN_TYPES):
+        return value
+    if isinstance(value, (RID, Record)):
+        return _encode_link(value)
+    if property_type in _LINK_TYPES:
+        if isinstance(value, dict):
+            return dict((k, _encode_link(v)) for k, v in value.iteritems())
+        if isinstance(value, (list, tuple, set)):
+            return [_encode_link(v) for v in value]
+        return _encode_link(value)
+    if isinstance(value, (list, tuple, set)):
+        return [_encode_value(v) for v in value]
+    if isinstance(value, dict):
+        return dict((k, _encode_value(v)) for k, v in value.iteritems())
+    if isinstance(value, bytearray):
+        import base64
+        return base64.b64encode(value)
+    import datetime
+    import decimal
+    if isinstance(value, datetime.date):
+        if property_type == 'DATE' or not isinstance(
+                value, datetime.datetime):
+            return value.strftime(DATE_FORMAT)
+        return value.strftime(DATETIME_FORMAT)
+    if isinstance(value, decimal.Decimal) and property_type not in (
+            _INTEGER_TYPES + _FLOAT_TYPES):
+        return str(value)
+    try:
+        if property_type in _INTEGER_TYPES and not isinstance(
+                value, (int, long)):
+            return int(value)
+        if property_type in _FLOAT_TYPES and not isinstance(value, float):
+            return float(value)
+    except (TypeError, ValueError):
+        return value
+    if property_type == 'BOOLEAN' and isinstance(value, basestring):
+        if value.lower() in ('true', 'false'):
+            return value.lower() == 'true'
+    if property_type == 'STRING' and not isinstance(value, basestring):
+        return unicode(value)
+    return value
+
+
+def _field_type_code(value):
+    """Returns the ``@fieldTypes`` code telling the server how to store
+       ``value`` in a property without a schema type, or None if JSON
+       carries its type already. The inverse of ``_decode_field``.
+    """
+    if value is None or isinstance(value, _PLAIN_TYPES):
+        return None
+    if isinstance(value, bytearray):
+        return 'b'
+    import datetime
+    import decimal
+    if isinstance(value, datetime.datetime):
+        return 't'
+    if isinstance(value, datetime.date):
+        return 'a'
+    if isinstance(value, decimal.Decimal):
+        return 'c'
+    return None
+
+
+class Record(object):
+    """Compact, read-only form of a document returned by a query. The
+       metadata is kept in slots (the @rid as a ``RID``), and the
+       properties in a tuple whose names are held once in a layout
+       shared by all records of the same shape. Values are decoded
+       according to ``@fieldTypes`` (links to ``RID``, dates to
+       ``datetime``, ...) only when they are read.
+
+       Records can be read like the dictionaries they replace, e.g.
+       ``record['uri']``, ``record.get('@rid')`` or ``record.keys()``;
+       ``to_dict()`` returns the document as the server sent it. The
+       metadata ('@rid', '@version', '@class', '@type', '@fieldTypes')
+       can be read and tested with ``in`` like the properties, but isn't
+       included in ``keys()``.
+    """
+    __slots__ = ('rid', 'version', 'class_name', '_layout', '_values',
+                 '_field_types')
+
+    def __init__(self, rid, version, class_name, layout, values,
+                 field_types=None):
+        self.rid = rid
+        self.version = version
+        self.class_name = class_name
+        self._layout = layout
+        self._values = values
+        self._field_types = field_types
+
+    @classmethod
+    def from_dict(cls, document):
+        """Makes a ``Record`` from a document decoded from JSON."""
+        if isinstance(document, Record):
+            return document
+        names = tuple(sorted(k for k in document if k[:1] != '@'))
+        rid = document.get('@rid')
+        class_name = document.get('@class')
+        return cls(
+            RID.parse(rid) if rid is not None else None,
+            document.get('@version'),
+            _intern(class_name) if class_name is not None else None,
+            _record_layout(names), tuple(document[k] for k in names),
+            document.get('@fieldTypes'))
+
+    def _types(self):
+        """Parses '@fieldTypes' (e.g. 'weight=d,out_E=g') on first use."""
+        if isinstance(self._field_types, basestring):
+            self._field_types = dict(
+                item.split('=', 1) for item in self._field_types.split(',')
+                if '=' in item)
+        return self._field_types or {}
+
+    def _metadata(self):
+        """Returns the record's metadata as ``to_dict`` holds it: the
+           ``RID`` under '@rid' and only the entries it has a value for.
+        """
+        metadata = {'@type': 'd'}
+        for name, value in (('@rid', self.rid), ('@version', self.version),
+                            ('@class', self.class_name)):
+            if value is not None:
+                metadata[name] = value
+        if self._field_types is not None:
+            metadata['@fieldTypes'] = ','.join(
+                '%s=%s' % item for item in sorted(self._types().items()))
+        return metadata
+
+    def __getitem__(self, name):
+        if name == '@rid' and self.rid is not None:
+            return self.rid
+        if name[:1] == '@':
+            return self._metadata()[name]
+        value = self._values[self._layout.positions[name]]
+        if self._field_types is not None:
+            field_type = self._types().get(name)
+            if field_type is not None:
+                return _decode_field(value, field_type)
+        return value
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        if name[:1] == '@':
+            return name in self._metadata()
+        return name in self._layout.positions
+
+    def __iter__(self):
+        return iter(self._layout.fields)
+
+    def __len__(self):
+        return len(self._values)
+
+    def keys(self):
+        return list(self._layout.fields)
+
+    def items(self):
+        return [(name, self[name]) for name in self._layout.fields]
+
+    def to_dict(self):
+        """Returns the record as a dictionary, with the values and
+           metadata the server sent.
+        """
+        document = dict(zip(self._layout.fields, self._values))
+        document.update(self._metadata())
+        if self.rid is not None:
+            document['@rid'] = str(self.rid)
+        return document
+
+    def __repr__(self):
+        return 'Record(%s, %s, %r)' % (
+            self.rid, self.class_name, dict(zip(self._layout.fields,
+                                                 self._values)))
+
+
+def _as_records(results, as_records):
+    """Converts a list or iterator of documents to ``Record`` objects if
+       ``as_records`` is set.
+    """
+    if not as_records:
+        return results
+    if isinstance(results, list):
+        return map(Record.from_dict, results)
+    return imap(Record.from_dict, results)
+
+
+class _Prefetch(object):
+    """Runs ``f(*args)`` in a background thread. ``result()`` waits for
+       it to finish and returns its value, re-raising any exception.
+    """
+    def __init__(self, f, *args):
+        self.value = None
+        self.error = None
+        self.thread = threading.Thread(target=self._run, args=(f, args))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, f, args):
+        try:
+            self.value = f(*args)
+        except Exception:
+            self.error = sys.exc_info()
+
+    def result(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+
+class Cursor(object):
+    """Iterates over the results of a query one page at a time. OrientDB
+       has no server-side cursors over REST, so pages are fetched with
+       keyset pagination: each page asks for the records whose @rid is
+       greater than the last one seen, ordered by @rid. Unlike SKIP, this
+       costs the same for every page and doesn't skip or repeat records
+       when the class changes during the walk.
+
+       ``fetch_page(after_rid, limit)`` must return the next page of
+       results after ``after_rid``, which is None for the first page. If
+       ``page_size`` is None, everything is fetched in a single page. If
+       ``limit`` is set, at most that many results are fetched in total.
+
+       A page is either a list or, for streamed results, an iterator that
+       yields the results as they are parsed. With ``prefetch`` set, the
+       next page after a list is requested in a background thread while
+       the caller consumes the current one; streamed pages are consumed
+       as they arrive instead.
+
+       Iterating over the cursor again re-runs the query from the start.
+    """
+    def __init__(self, fetch_page, page_size=DEFAULT_PAGE_SIZE,
+                 prefetch=True, limit=None):
+        self.fetch_page = fetch_page
+        self.page_size = page_size
+        self.prefetch = prefetch
+        self.limit = limit
+        self.pages_fetched = 0
+        self.rows_fetched = 0
+
+    def _fetch(self, after_rid, fetched=0):
+        """Fetches the page after ``after_rid``, given that ``fetched``
+           results have been fetched so far in this walk.
+        """
+        limit = -1 if self.page_size is None else self.page_size
+        if self.limit is not None:
+            remaining = self.limit - fetched
+            if remaining <= 0:
+                return []
+            limit = remaining if limit == -1 else min(limit, remaining)
+        page = self.fetch_page(after_rid, limit)
+        self.pages_fetched += 1
+        return page
+
+    def _is_last_page(self, count, fetched):
+        """Whether a page of ``count`` results, bringing the total to
+           ``fetched``, is the last one.
+        """
+        if count == 0:
+            return True
+        if self.limit is not None and fetched >= self.limit:
+            return True
+        return self.page_size is None or count < self.page_size
+
+    def _last_rid(self, result):
+        rid = result.get('@rid')
+        if rid is None or _rid_key(rid)[0] < 0:
+            raise ValueError(
+                'Keyset pagination needs records with a persistent @rid, '
+                'got %r. Page the query with page_size=None instead.' % (rid))
+        return rid
+
+    def __iter__(self):
+        fetched = 0
+        page = self._fetch(None, fetched)
+        while True:
+            if isinstance(page, list):
+                fetched += len(page)
+                self.rows_fetched += len(page)
+                if self._is_last_page(len(page), fetched):
+                    next_page = None
+                elif self.prefetch:
+                    next_page = _Prefetch(
+                        self._fetch, self._last_rid(page[-1]), fetched)
+                else:
+                    next_page = self._last_rid(page[-1])
+                for result in page:
+                    yield result
+            else:
+                count = 0
+                for result in page:
+                    count += 1
+                    self.rows_fetched += 1
+                    yield result
+                fetched += count
+                if self._is_last_page(count, fetched):
+                    next_page = None
+                else:
+                    next_page = self._last_rid(result)
+            if next_page is None:
+                return
+            elif isinstance(next_page, _Prefetch):
+                page = next_page.result()
+            else:
+                page = self._fetch(next_page, fetched)
+
+
+def _response_error(name, response):
+    """Returns an OrientDBResponseError for the non-2XX ``response`` to
+       the operation ``name``, with the server's error messages if it
+       sent any.
+    """
+    message = '%s failed. Got response %s.' % (name, response.status_code)
+    try:
+        errors = response.json().get('errors') or []
+    except (ValueError, AttributeError):
+        errors = []
+    for error in errors:
+        if isinstance(error, dict):
+            error = error.get('content') or error.get('reason')
+        message = ' '.join([message, unicode(error)])
+    return OrientDBResponseError(message)
 
 
 def _check_response_code(f, *args, **kwargs):
@@ -77,12 +727,12 @@ def _check_response_code(f, *args, **kwargs):
        code is in the 200's, signifying that all is well. If not, raises
        an OrientDBResponseError.
     """
+    @functools.wraps(f)
     def inner_function(*args, **kwargs):
         out = f(*args, **kwargs)
         code = out.status_code
-        print 'in the decorator...', code
         if str(code)[0] != '2':
-            raise OrientDBResponseError
+            raise _response_error(f.__name__, out)
         else:
             return out
     return inner_function
@@ -92,125 +742,1189 @@ def _check_response_code(f, *args, **kwargs):
 def _update_document(db_connection, record_id, payload, update_mode='full'):
     """Updates a document by its record-id. Payload is a dictionary.
        Returns the response from the sever."""
-    record_id = record_id.replace('#', '')
+    record_id = _rid_format(record_id)[1:]
     payload = json.dumps(payload)
     request_url = '/'.join([
         db_connection.server_address, 'document',
         db_connection.database, record_id])
-    response = requests.post(
-        request_url, cookies=db_connection.auth_cookie, data=payload)
+    response = db_connection._request(
+        'post', request_url, 'document', data=payload)
     return response
 
 
-# @_paginate
-def _select_from(db_connection, target, where_clause_dict, skip=0):
-    """Selects (using the SQL-like language) from the database.
+def _command_payload(command_text, parameters=None):
+    """Returns the JSON body for a command or query sent by POST.
+       ``parameters`` is a list for positional (``?``) parameters or a
+       dictionary for named (``:name``) parameters.
+    """
+    payload = {'command': command_text}
+    if parameters is not None:
+        payload['parameters'] = parameters
+    return json.dumps(payload)
+
+
+_SCHEMA_COMMAND = re.compile(
+    r'\s*(CREATE|ALTER|DROP|TRUNCATE)\s+(CLASS|PROPERTY)\b', re.I)
+# SQL statements that only read, so they can safely be sent again
+_READ_ONLY_QUERY = re.compile(r'\s*(SELECT|TRAVERSE|MATCH|EXPLAIN)\b', re.I)
+# SQL commands that can't change any stored record
+_READ_ONLY_COMMAND = re.compile(
+    r'\s*(SELECT|TRAVERSE|EXPLAIN|MATCH|(CREATE|DROP|REBUILD)\s+INDEX|'
+    r'CREATE\s+(CLASS|PROPERTY))\b', re.I)
+
 
-       Using a private method outside the class definition because we
-       want to use decorators for pagination, and there's a lot of
-       weird voodoo when you apply a decorator inside a class definition.
+def _post_command(db_connection, command_text, language='sql',
+                  parameters=None):
+    """Sends a command to the server. Returns the response."""
+    request_url = '/'.join([db_connection.server_address, 'command',
+                            db_connection.database, language])
+    return db_connection._request(
+        'post', request_url, 'command',
+        data=_command_payload(command_text, parameters))
 
-       In these cases, there will always be a class method that calls
-       the private method, and iterates through the results.
+
+def _iter_streamed_results(db_connection, response):
+    """Yields the documents of a streamed query response as they are
+       parsed, closing the response and recording its metric when done.
     """
-    raw_query_text = 'SELECT FROM %s WHERE %s SKIP %s' % (
-        target, where_clause_dict, skip)
-    # print raw_query_text
-    query_text = urllib2.quote(raw_query_text)
-    request_url = '/'.join([db_connection.server_address, 'query',
-                            db_connection.database, 'sql', query_text])
-    response = requests.get(request_url, cookies=db_connection.auth_cookie)
+    metric = response.metric
+    start = time.time()
+    rows = 0
+    def count_bytes(chunks):
+        for chunk in chunks:
+            metric.response_bytes += len(chunk)
+            yield chunk
     try:
-        result_list = response.json()['result']
+        for result in iter_json_array(count_bytes(response.iter_content(
+                DEFAULT_STREAM_CHUNK_SIZE)), 'result'):
+            rows += 1
+            yield result
+    finally:
+        response.close()
+        metric.transfer = time.time() - start
+        metric.rows = rows
+        db_connection._record(metric)
+
+
+def _query_page(db_connection, query_text, language, limit,
+                fetch_plan=None, parameters=None, stream=False):
+    """Runs one query and returns the list of results. The query is sent
+       in the body of a POST to the command endpoint (with ``-`` in place
+       of the command text in the URL), so its length isn't limited by
+       the URL and its ``parameters`` can be bound by the server.
+
+       ``limit`` is passed to the server, which otherwise caps the result
+       at 20 records; -1 means no limit. ``fetch_plan`` controls how deep
+       linked records are expanded in the results.
+
+       With ``stream`` set, returns an iterator that parses the results
+       from the response as they arrive instead, so only one document is
+       decoded and held at a time.
+
+       Only read-only SQL (SELECT, TRAVERSE, MATCH and EXPLAIN) is sent as
+       a query, which is retried on transient failures. Anything else
+       may write, so it is sent once, as a command, and clears the
+       connection's caches as ``post_command`` does.
+
+       Raises an OrientDBResponseError if the server refuses the query.
+    """
+    read_only = language == 'sql' and _READ_ONLY_QUERY.match(query_text)
+    url_parts = [db_connection.server_address, 'command',
+                 db_connection.database, language, '-', str(limit)]
+    if fetch_plan is not None:
+        url_parts.append(urllib2.quote(fetch_plan))
+    request_url = '/'.join(url_parts)
+    response = db_connection._request(
+        'post', request_url, 'query' if read_only else 'command',
+        defer=True, data=_command_payload(query_text, parameters),
+        stream=stream)
+    if not read_only:
+        db_connection._command_sent(query_text, language)
+    if str(response.status_code)[0] != '2':
+        error = _response_error('query', response)
+        response.close()
+        db_connection._record(response.metric)
+        raise error
+    if stream:
+        return _iter_streamed_results(db_connection, response)
+    try:
+        result_list = db_connection._decode(response)['result']
     except ValueError:
         result_list = []
     return result_list
 
 
-@_paginate
-def _get_query(db_connection, query_text, language, skip=0):
-    """Uses the GET method to execute a query. Note that in the orientDB
-       scheme, GET requests are "idempotent", meaning that they don't
-       modify the database.
+# alias for @rid in projections, unlikely to clash with a property name
+_RID_ALIAS = '_rid_'
+
+
+def _projection(fields):
+    """Returns the projection of a SELECT that returns only ``fields``,
+       plus the @rid of each record (as ``_RID_ALIAS``, since the
+       projected rows are temporary records with their own @rid), and the
+       field to order the rows by @rid. ``fields`` may be None for whole
+       records.
+    """
+    if fields is None:
+        return '', '@rid'
+    if isinstance(fields, basestring):
+        fields = [fields]
+    return '@rid AS %s, %s ' % (_RID_ALIAS, ', '.join(fields)), _RID_ALIAS
+
+
+def _restore_rid(result):
+    if _RID_ALIAS in result:
+        result['@rid'] = result.pop(_RID_ALIAS)
+    return result
 
-       The ``query_text`` is being passed via the URL, so we
-       might choke on ridiculously long queries.
-    
-       TODO: Include support for an optional fetchPlan.
-    """
-    query_text = urllib2.quote(query_text)
-    query_text += ' skip=%s' % (skip)
-    request_url = '/'.join([db_connection.server_address, 'query',
-                            db_connection.database, language, query_text])
-    # print request_url
-    response = requests.get(request_url, cookies=db_connection.auth_cookie)
-    result_list = response.json()['result']
-    return result_list
+
+def _restore_rids(results, fields):
+    """Puts the @rid returned by a ``_projection`` query back under the
+       '@rid' key of each row, so projected rows can be paged and used
+       like whole records. ``results`` may be a list or an iterator.
+    """
+    if fields is None:
+        return results
+    if isinstance(results, list):
+        return map(_restore_rid, results)
+    return imap(_restore_rid, results)
+
+
+def _select_query(target, where, after_rid=None, limit=-1, fields=None):
+    """Returns the text of the query for one page of ``_select_from``."""
+    projection, order_by = _projection(fields)
+    conditions = []
+    if where:
+        conditions.append('(%s)' % (where))
+    if after_rid is not None:
+        conditions.append('@rid > %s' % (_rid_format(after_rid)))
+    query_text = 'SELECT %sFROM %s' % (projection, target)
+    if len(conditions) > 0:
+        query_text += ' WHERE ' + ' AND '.join(conditions)
+    query_text += ' ORDER BY %s ASC LIMIT %s' % (order_by, limit)
+    return query_text
+
+
+def _where_parameters(where, parameters):
+    """Compiles a dictionary ``where`` into a parameterized condition,
+       merging its parameters with ``parameters``. Returns the condition
+       and the parameters to send with it.
+    """
+    if not isinstance(where, dict):
+        return where, parameters
+    if isinstance(parameters, list):
+        raise ValueError('A dictionary where needs named parameters.')
+    where, where_parameters = compile_where(where)
+    if parameters is not None:
+        where_parameters.update(parameters)
+    return where, where_parameters
+
+
+def _traversal_function(direction, edge_class=None):
+    """Returns the graph function that follows ``edge_class`` edges (a
+       class name, a list of them, or None for all edges) in
+       ``direction``, e.g. ``out('sung_by')``.
+    """
+    direction = direction.lower()
+    if direction not in DIRECTIONS:
+        raise ValueError('Unknown direction %r.' % (direction))
+    if edge_class is None:
+        edge_class = []
+    elif isinstance(edge_class, basestring):
+        edge_class = [edge_class]
+    return '%s(%s)' % (
+        direction, ', '.join("'%s'" % (name) for name in edge_class))
+
+
+def _traversal_target(record_ids):
+    """Returns the FROM target for one record id or a list of them."""
+    if isinstance(record_ids, (list, set)):
+        return '[%s]' % (', '.join(_rid_format(rid) for rid in record_ids))
+    return _rid_format(record_ids)
+
+
+def _select_from(db_connection, target, where, after_rid=None, limit=-1,
+                 fields=None, fetch_plan=None, parameters=None, stream=False):
+    """Selects (using the SQL-like language) from the database. Returns
+       one page of at most ``limit`` records, ordered by @rid, whose @rid
+       is greater than ``after_rid``. If ``fields`` is given, only those
+       properties are returned.
+
+       In these cases, there will always be a class method that wraps the
+       private method in a ``Cursor`` to iterate through all the pages.
+    """
+    query_text = _select_query(target, where, after_rid, limit, fields)
+    return _restore_rids(_query_page(
+        db_connection, query_text, 'sql', limit, fetch_plan=fetch_plan,
+        parameters=parameters, stream=stream), fields)
+
+
+_KEYSET_QUERY = re.compile(r'\s*(SELECT\s+(\*\s+)?FROM|TRAVERSE)\b', re.I)
+_ORDER_BY = re.compile(r'\bORDER\s+BY\b', re.I)
+
+
+def _check_keyset_query(query_text):
+    """Raises a ValueError unless ``query_text`` can be paged by @rid:
+       it must return whole stored records and must not have its own
+       ORDER BY, which the paging would override.
+    """
+    if not _KEYSET_QUERY.match(query_text) or _ORDER_BY.search(query_text):
+        raise ValueError(
+            'Only SELECT FROM and TRAVERSE queries without ORDER BY can be '
+            'paged by @rid; use keyset=False for %r.' % (query_text))
+
+
+def _get_query(db_connection, query_text, language, after_rid=None,
+               limit=-1, keyset=False, fields=None, fetch_plan=None,
+               parameters=None, stream=False):
+    """Executes a query with optional ``parameters``, returning one page
+       of results.
+
+       If ``keyset`` is set (SQL only), the query is wrapped in a
+       subquery so that one page of at most ``limit`` records after
+       ``after_rid`` is returned. If ``fields`` is given (SQL only), the
+       results are projected on them. Otherwise the query is sent as-is.
+    """
+    if language == 'sql' and (keyset or fields is not None) and (
+            _READ_ONLY_QUERY.match(query_text)):
+        projection, order_by = _projection(fields)
+        query_text = 'SELECT %sFROM (%s)' % (projection, query_text)
+        if keyset:
+            if after_rid is not None:
+                query_text += ' WHERE @rid > %s' % (_rid_format(after_rid))
+            query_text += ' ORDER BY %s ASC LIMIT %s' % (order_by, limit)
+    else:
+        fields = None
+    return _restore_rids(_query_page(
+        db_connection, query_text, language, limit, fetch_plan=fetch_plan,
+        parameters=parameters, stream=stream), fields)
+
+
+# the characters that can end a JSON string, and those that open or close
+# a string, object or array outside of one
+_JSON_STRING_SPECIAL = re.compile(r'["\\]')
+_JSON_NESTING_SPECIAL = re.compile(r'["{}\[\]]')
+# the characters that can follow a number, true, false or null
+_JSON_SCALAR_END = re.compile(r'[\s,:\]}]')
+
+
+class _JSONStream(object):
+    """Incremental reader over JSON text arriving in ``chunks``. The end
+       of each value is found by scanning the chunks as they arrive,
+       keeping track of nesting and of whether the scan is inside a
+       string, and the value is then decoded once with ``raw_decode``.
+       Text that has been consumed is dropped, so only about one value is
+       held in memory at a time.
+    """
+    decoder = json.JSONDecoder()
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+        self.position = 0
+        self.exhausted = False
+
+    def _read(self):
+        """Returns the next non-empty chunk, or '' at the end of the
+           input.
+        """
+        if not self.exhausted:
+            for chunk in self.chunks:
+                if chunk:
+                    return chunk
+            self.exhausted = True
+        return ''
+
+    def _fill(self):
+        """Reads another chunk. Returns False at the end of the input."""
+        chunk = self._read()
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def peek(self):
+        """Returns the next non-whitespace character without consuming
+           it, or '' at the end of the input.
+        """
+        while True:
+            while self.position < len(self.buffer) and (
+                    self.buffer[self.position] in ' \t\r\n'):
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._fill():
+                return ''
+
+    def expect(self, characters):
+        """Consumes the next non-whitespace character, which must be one
+           of ``characters``, and returns it.
+        """
+        character = self.peek()
+        if character == '' or character not in characters:
+            raise ValueError('Expected one of %r in JSON stream, got %r.' % (
+                characters, character))
+        self.position += 1
+        return character
+
+    def decode(self):
+        """Decodes and consumes the next JSON value."""
+        first = self.peek()
+        if first == '':
+            raise ValueError('Expected a value in JSON stream, got %r.' % (
+                first))
+        scalar = first not in '{["'
+        state = [int(first != '"'), first == '"', False]
+        pieces = []
+        text = self.buffer
+        start = self.position
+        end = -1
+        if scalar:
+            match = _JSON_SCALAR_END.search(text, start)
+            while match is None:
+                pieces.append(text[start:])
+                text, start = self._read(), 0
+                if not text:
+                    break
+                match = _JSON_SCALAR_END.search(text)
+            end = len(text) if match is None else match.start()
+        else:
+            end = _scan_json(text, start + 1, state)
+            while end < 0:
+                pieces.append(text[start:])
+                text, start = self._read(), 0
+                if not text:
+                    raise ValueError('Unexpected end of JSON stream.')
+                end = _scan_json(text, 0, state)
+        if pieces:
+            # joined once, when the value is complete
+            pieces.append(text)
+            self.buffer = ''.join(pieces)
+            end += len(self.buffer) - len(text)
+            self.position = 0
+        value, decoded_end = self.decoder.raw_decode(
+            self.buffer, self.position)
+        if decoded_end != end:
+            raise ValueError('Unexpected %r in JSON stream.' % (
+                self.buffer[decoded_end:end][:20]))
+        self.position = end
+        return value
+
+
+def _scan_json(text, position, state):
+    """Scans ``text`` from ``position`` for the end of a string, object
+       or array, given the ``state`` its scan had reached: the depth of
+       nesting, whether it is inside a string, and whether the previous
+       chunk ended on a backslash. Returns the index just past the end,
+       or -1 if the value continues past ``text``, updating ``state``.
+    """
+    depth, in_string, escaped = state
+    if escaped:
+        position += 1
+        escaped = False
+    while True:
+        if in_string:
+            match = _JSON_STRING_SPECIAL.search(text, position)
+            if match is None:
+                break
+            position = match.end()
+            if match.group() == '\\':
+                if position == len(text):
+                    escaped = True
+                    break
+                position += 1
+                continue
+            in_string = False
+            if depth == 0:
+                return position
+            continue
+        match = _JSON_NESTING_SPECIAL.search(text, position)
+        if match is None:
+            break
+        position = match.end()
+        character = match.group()
+        if character == '"':
+            in_string = True
+        elif character in '{[':
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return position
+    state[:] = [depth, in_string, escaped]
+    return -1
+
+
+def iter_json_array(chunks, key):
+    """Yields the elements of the array stored under ``key`` in the JSON
+       object whose text arrives in ``chunks`` (e.g. the ``result`` of a
+       query, or the ``records`` of a database export), one at a time as
+       they are parsed. The other top-level values are decoded and
+       discarded.
+    """
+    stream = _JSONStream(chunks)
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        name = stream.decode()
+        stream.expect(':')
+        if name == key and stream.peek() == '[':
+            stream.expect('[')
+            if stream.peek() == ']':
+                return
+            while True:
+                yield stream.decode()
+                if stream.expect(',]') == ']':
+                    return
+        stream.decode()
+        if stream.expect(',}') == '}':
+            return
+
+
+def _iter_file_chunks(f, chunk_size=DEFAULT_STREAM_CHUNK_SIZE):
+    """Yields ``f``'s contents ``chunk_size`` bytes at a time."""
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_export_records(file_name, chunk_size=DEFAULT_STREAM_CHUNK_SIZE):
+    """Yields the records of a database export written by
+       ``OrientDBConnection.export_database`` one at a time, without
+       loading the file into memory. Files ending in '.gz' are
+       decompressed on the fly.
+    """
+    if file_name.lower()[-3:] == '.gz':
+        f = gzip.open(file_name, 'rb')
+    else:
+        f = open(file_name, 'rb')
+    try:
+        for record in iter_json_array(
+                _iter_file_chunks(f, chunk_size), 'records'):
+            yield record
+    finally:
+        f.close()
+
+
+def iter_key_paths(document, record_separator='.', key_path=None):
+    """Yields a (key path, value) pair for each non-dictionary value in a
+       possibly nested dictionary, where the key path is the
+       ``record_separator``-delimited string of keys leading to the value.
+       Nothing is copied.
+    """
+    for k, v in document.iteritems():
+        if key_path is not None:
+            k = record_separator.join([key_path, k])
+        if isinstance(v, dict):
+            for item in iter_key_paths(v, record_separator, k):
+                yield item
+        else:
+            yield k, v
 
 
 def get_path_list_from_dict(document, record_separator='.'):
     """Converts a dictionary-like document to a set of constraints suitable
        for matching in the SQL language.
     """
-    path_list = []
-    def inner_function(d, keypath=''):
-        for k, v in d.iteritems():
-            if not isinstance(v, dict):
-                if len(keypath) > 0:
-                    path_list.append(record_separator.join([keypath, k]))
-                else:
-                    path_list.append(k)
-                keypath = ''
-            else:
-                if len(keypath) > 0:
-                    inner_function(
-                        v, keypath=record_separator.join([keypath, k]))
-                else:
-                    inner_function(v, keypath=k)
-    inner_function(document)
-    return path_list
+    return [key_path for key_path, _ in iter_key_paths(
+        document, record_separator=record_separator)]
 
 
 def flatten_dict(document, record_separator='.'):
     """Creates a new dictionary by replacing the nested key structure
        with dot-delimited keypath strings.
     """
-    path_list = get_path_list_from_dict(
-        document, record_separator=record_separator)
-    d = {}
-    for key_path in path_list:
-        v = copy.deepcopy(document)
-        for key in key_path.split(record_separator):
-            v = v[key]
-        d[key_path] = v
-    return d
+    return dict(iter_key_paths(document, record_separator=record_separator))
+
+
+MAX_WHERE_TEMPLATES = 1024
+_where_templates = {}
+
+
+def _where_template(key_paths):
+    """Returns the parameterized WHERE clause matching the tuple of
+       ``key_paths``, e.g. ``a.b = :p0 AND c = :p1``. Templates are cached
+       by their key paths, so documents of the same shape share one.
+    """
+    template = _where_templates.get(key_paths)
+    if template is None:
+        template = ' AND '.join(
+            '%s = :p%d' % (key_path, i)
+            for i, key_path in enumerate(key_paths))
+        if len(_where_templates) >= MAX_WHERE_TEMPLATES:
+            _where_templates.clear()
+        _where_templates[key_paths] = template
+    return template
+
+
+def compile_where(document):
+    """Takes a possibly nested dictionary and returns a (clause,
+       parameters) pair: the parameterized "where" clause of a SQL command
+       that matches the dictionary's key/value pairs, and the dictionary
+       of named parameters to bind to it. The values are sent to the
+       server as parameters, so they need no quoting or escaping.
+    """
+    if len(document) == 0:
+        raise Exception(
+            'tried to create a WHERE clause from an empty dictionary.')
+    items = sorted(iter_key_paths(document))
+    clause = _where_template(tuple(key_path for key_path, _ in items))
+    parameters = dict(('p%d' % (i), v) for i, (_, v) in enumerate(items))
+    return clause, parameters
+
 
 def where_clause(document):
     """Takes a possibly nested dictionary and returns the "where" clause of
-       a SQL command that matches the dictionary's key/value pairs.
+       a SQL command that matches the dictionary's key/value pairs. The
+       values are written into the clause as literals; prefer
+       ``compile_where`` for queries that are run repeatedly.
     """
     if len(document) == 0:
         raise Exception(
             'tried to create a WHERE clause from an empty dictionary.')
-    clause = ''
-    flattened_dictionary = flatten_dict(document)
-    for k, v in flattened_dictionary.iteritems():
-        if isinstance(v, str) or isinstance(v, unicode):
-            v = '"' + v + '"'
+    conditions = []
+    for k, v in iter_key_paths(document):
+        if isinstance(v, basestring) or isinstance(v, bool) or v is None:
+            v = json.dumps(v)
         else:
-            print v, 'is type', type(v)
             v = str(v)
-        clause += '%s = %s, ' % (k, v)
-    clause = clause[:-2] # get rid of the extra comma and space
-    # clause = 'where ' + clause
-    return clause
+        conditions.append('%s = %s' % (k, v))
+    return ' AND '.join(conditions)
+
+
+@_check_response_code
+def _post_batch(db_connection, operations, transaction=False):
+    """Sends a list of operations to the REST batch endpoint.
+       Returns the response from the server.
+    """
+    payload = json.dumps(
+        {'transaction': transaction, 'operations': operations})
+    request_url = '/'.join([
+        db_connection.server_address, 'batch', db_connection.database])
+    response = db_connection._request(
+        'post', request_url, 'batch', defer=True, data=payload)
+    return response
+
+
+def _extract_rid(result):
+    """Pulls the @rid out of one item of a batch script result. Commands
+       like CREATE EDGE return a list of records, in which case the rid
+       of the first one is used. Returns None for results that aren't
+       records (e.g. the count returned by UPDATE or DELETE).
+    """
+    if isinstance(result, list):
+        if len(result) == 0:
+            return None
+        result = result[0]
+    if isinstance(result, dict):
+        return result.get('@rid')
+    if isinstance(result, basestring) and result[:1] == '#':
+        return result
+    return None
+
+
+def _index_fields(index):
+    """Returns the list of properties covered by an index, as described
+       by the server's index manager.
+    """
+    definition = index.get('indexDefinition') or {}
+    if 'indexDefinitions' in definition:
+        return [d.get('field') for d in definition['indexDefinitions']]
+    if 'fields' in definition:
+        return list(definition['fields'])
+    if 'field' in definition:
+        return [definition['field']]
+    return []
+
+
+def _uses_index(plan):
+    """Tells whether an execution plan returned by EXPLAIN reads from an
+       index. OrientDB 2.x lists the indexes in ``involvedIndexes``; 3.x
+       describes the plan in ``executionPlanAsString``.
+    """
+    if plan.get('involvedIndexes'):
+        return True
+    return 'FETCH FROM INDEX' in plan.get('executionPlanAsString', '')
+
+
+class RidCache(object):
+    """Base class for caches mapping a (class name, property, value) key
+       to the @rid of the record that has that value. Subclasses store
+       the entries by implementing ``_get``, ``_set``, ``_discard`` and
+       ``__len__``.
+
+       ``hits`` and ``misses`` count the lookups, so that the cache can be
+       sized by looking at ``stats()`` after a run.
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the @rid cached for ``key``, or None."""
+        with self.lock:
+            rid = self._get(key)
+            if rid is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return rid
+
+    def set(self, key, rid):
+        """Caches ``rid`` as the @rid for ``key``."""
+        with self.lock:
+            self._set(key, rid)
+
+    def discard(self, rids):
+        """Drops the entries pointing at any of ``rids``, e.g. because
+           those records were deleted.
+        """
+        rids = set(_rid_format(rid) for rid in rids)
+        if len(rids) > 0:
+            with self.lock:
+                self._discard(rids)
+
+    def stats(self):
+        """Returns a dictionary of the cache's size and hit/miss counts."""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self), 'hits': self.hits, 'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+
+class LRURidCache(RidCache):
+    """In-memory ``RidCache`` that holds at most ``max_size`` entries,
+       evicting the least recently used one when it is full.
+    """
+    def __init__(self, max_size=DEFAULT_RID_CACHE_SIZE):
+        super(LRURidCache, self).__init__()
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _get(self, key):
+        rid = self.entries.pop(key, None)
+        if rid is not None:
+            self.entries[key] = rid
+        return rid
+
+    def _set(self, key, rid):
+        self.entries.pop(key, None)
+        self.entries[key] = rid
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def _discard(self, rids):
+        for key in [key for key, rid in self.entries.iteritems()
+                    if rid in rids]:
+            del self.entries[key]
+
+
+class SqliteRidCache(RidCache):
+    """``RidCache`` kept in a sqlite database at ``path``, for imports
+       with more keys than fit in memory. The file can be reused across
+       runs of the same import.
+    """
+    def __init__(self, path):
+        import sqlite3
+        super(SqliteRidCache, self).__init__()
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS rid_cache '
+            '(key TEXT PRIMARY KEY, rid TEXT)')
+        self.connection.commit()
+        self.pending_writes = 0
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute(
+                'SELECT COUNT(*) FROM rid_cache').fetchone()[0]
+
+    def _get(self, key):
+        row = self.connection.execute(
+            'SELECT rid FROM rid_cache WHERE key = ?',
+            (json.dumps(key),)).fetchone()
+        return None if row is None else row[0]
+
+    def _set(self, key, rid):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO rid_cache (key, rid) VALUES (?, ?)',
+            (json.dumps(key), rid))
+        self.pending_writes += 1
+        if self.pending_writes >= DEFAULT_BATCH_SIZE:
+            self.connection.commit()
+            self.pending_writes = 0
+
+    def _discard(self, rids):
+        self.connection.executemany(
+            'DELETE FROM rid_cache WHERE rid = ?', [(rid,) for rid in rids])
+        self.connection.commit()
+        self.pending_writes = 0
+
+    def close(self):
+        """Commits outstanding entries and closes the database."""
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+def _copy_document(value):
+    """Copies a decoded JSON value, down to its nested dicts and lists."""
+    if isinstance(value, dict):
+        return dict((key, _copy_document(item))
+                    for key, item in value.iteritems())
+    if isinstance(value, list):
+        return [_copy_document(item) for item in value]
+    return value
+
+
+class DocumentCache(object):
+    """Read-through cache of documents keyed by @rid, holding at most
+       ``max_size`` documents for at most ``ttl`` seconds each (forever if
+       ``ttl`` is None). The least recently used document is evicted when
+       the cache is full.
+
+       Documents are copied on the way in and out, so changing a
+       document that was cached or read from the cache doesn't change
+       the cached copy.
+
+       Each document's @version is used to detect staleness: a document
+       read from the server replaces the cached copy only if it isn't
+       older, so an out-of-date page of query results can't overwrite a
+       newer copy. Writes made through the owning connection invalidate
+       the records they touch; commands sent with its ``post_command``
+       that may write clear the whole cache. Writes made by other
+       clients are only noticed when the document is read again through
+       a query, or when its ``ttl`` runs out.
+    """
+    def __init__(self, max_size=DEFAULT_DOCUMENT_CACHE_SIZE, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, record_id):
+        """Returns the cached document for ``record_id``, or None."""
+        record_id = _rid_format(record_id)
+        with self.lock:
+            entry = self.entries.pop(record_id, None)
+            if entry is not None and self.ttl is not None and (
+                    entry[1] < time.time()):
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[record_id] = entry
+            self.hits += 1
+        return _copy_document(entry[0])
+
+    def put(self, document):
+        """Caches ``document`` unless a newer version of it is cached."""
+        record_id = document.get('@rid')
+        if record_id is None or _rid_key(record_id)[0] < 0:
+            return
+        expires = None if self.ttl is None else time.time() + self.ttl
+        document = _copy_document(document)
+        with self.lock:
+            entry = self.entries.pop(record_id, None)
+            if entry is not None and entry[0].get('@version', -1) > (
+                    document.get('@version', -1)):
+                document, expires = entry
+            self.entries[record_id] = (document, expires)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, record_id):
+        """Drops ``record_id`` from the cache."""
+        with self.lock:
+            if self.entries.pop(_rid_format(record_id), None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Returns a dictionary of the cache's size and counters."""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self), 'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+
+class SchemaCache(object):
+    """Local copy of the database schema: the classes, their superclasses
+       and the types of their properties, as described by the server's
+       database metadata. It is loaded from the server the first time the
+       connection needs it and again after ``invalidate``. Classes and
+       properties created through the connection are added to it as they
+       are created, without reloading it. Names are matched
+       case-insensitively, as OrientDB does.
+
+       ``available`` is False if the server wouldn't describe the
+       schema, in which case the cache holds only the classes and
+       properties created since.
+    """
+    def __init__(self):
+        self.classes = None
+        self.types = {}
+        self.available = False
+        self.loads = 0
+        self.lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self.classes is not None
+
+    def load(self, classes, available=True):
+        """Replaces the cached schema with ``classes``, a list of class
+           descriptions like those returned by ``class_information``.
+        """
+        loaded = dict((description['name'].lower(), description)
+                      for description in classes)
+        with self.lock:
+            self.classes = loaded
+            self.types = {}
+            self.available = available
+            self.loads += 1
+
+    def invalidate(self):
+        """Drops the cached schema, so it is reloaded when next needed."""
+        with self.lock:
+            self.classes = None
+            self.types = {}
+
+    def get_class(self, class_name):
+        """Returns the description of ``class_name``, or None."""
+        return (self.classes or {}).get(class_name.lower())
+
+    def has_class(self, class_name):
+        return self.get_class(class_name) is not None
+
+    def superclasses(self, class_name):
+        """Returns the names of the classes ``class_name`` extends."""
+        description = self.get_class(class_name) or {}
+        names = description.get('superClasses')
+        if names is None:
+            names = [description.get('superClass')]
+        return [name for name in names if name]
+
+    def property_types(self, class_name):
+        """Returns a dictionary mapping the lower-cased names of the
+           properties of ``class_name``, including inherited ones, to
+           their types.
+        """
+        key = class_name.lower()
+        types = self.types.get(key)
+        if types is not None:
+            return types
+        types = {}
+        pending, seen = [class_name], set()
+        while pending:
+            name = pending.pop()
+            if name.lower() in seen:
+                continue
+            seen.add(name.lower())
+            description = self.get_class(name) or {}
+            for prop in description.get('properties') or []:
+                types.setdefault(prop['name'].lower(), prop['type'].upper())
+            pending.extend(self.superclasses(name))
+        with self.lock:
+            if self.classes is not None:
+                self.types[key] = types
+        return types
+
+    def property_type(self, class_name, property_name):
+        """Returns the type of ``class_name``'s property ``property_name``,
+           or None if the schema doesn't define it.
+        """
+        return self.property_types(class_name).get(property_name.lower())
+
+    def add_class(self, description):
+        """Adds or replaces the class described by ``description``."""
+        with self.lock:
+            if self.classes is not None:
+                self.classes[description['name'].lower()] = description
+                self.types = {}
+
+    def add_property(self, class_name, property_name, property_type):
+        """Records that ``class_name`` has the property ``property_name``
+           of type ``property_type``.
+        """
+        with self.lock:
+            description = (self.classes or {}).get(class_name.lower())
+            if description is None:
+                return
+            properties = [
+                prop for prop in description.get('properties') or []
+                if prop['name'].lower() != property_name.lower()]
+            properties.append(
+                {'name': property_name, 'type': property_type.upper()})
+            description['properties'] = properties
+            self.types = {}
+
+
+class PendingRecord(object):
+    """Placeholder for an operation queued in a ``BatchWriter``. Once the
+       batch containing the operation has been flushed, ``rid`` holds the
+       @rid of the record that was created (or None for operations that
+       don't create a record) and ``result`` holds the raw result returned
+       by the server.
+
+       A ``PendingRecord`` can be passed as the source or target of
+       ``BatchWriter.create_edge``, whether or not it has been flushed yet.
+    """
+    def __init__(self, writer, index, statement, cache_key=None,
+                 touches=(), deletes=None):
+        self.writer = writer
+        self.index = index
+        self.statement = statement
+        self.cache_key = cache_key
+        self.touches = touches
+        self.deletes = deletes
+        self.rid = None
+        self.result = None
+        self.flushed = False
+
+    def __repr__(self):
+        return '<PendingRecord %s>' % (self.rid or 'unflushed')
+
+
+class BatchWriter(object):
+    """Queues creates, updates and deletes and sends them to the server
+       through the REST batch endpoint, ``batch_size`` operations at a
+       time. Each chunk is sent as one SQL script, so a record created
+       earlier in the same chunk can be referenced by a later operation
+       without a round trip. If ``transaction`` is set, each chunk is
+       committed atomically.
+
+       Can be used as a context manager, in which case the remaining
+       operations are flushed on exit:
+
+           with connection.batch(batch_size=1000) as batch:
+               a = batch.create_vertex('person', {'name': 'a'})
+               b = batch.create_vertex('person', {'name': 'b'})
+               batch.create_edge(a, b, subclass='knows')
+           print a.rid, b.rid
+    """
+    def __init__(self, db_connection, batch_size=DEFAULT_BATCH_SIZE,
+                 transaction=False):
+        self.db_connection = db_connection
+        self.batch_size = batch_size
+        self.transaction = transaction
+        self.queue = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.queue = []
+        return False
+
+    def __len__(self):
+        return len(self.queue)
+
+    def _reference(self, record_id):
+        """Returns the SQL used to refer to ``record_id`` from inside the
+           current chunk's script.
+        """
+        if isinstance(record_id, PendingRecord):
+            if record_id.flushed:
+                if record_id.rid is None:
+                    raise ValueError(
+                        '%r did not create a record.' % (record_id))
+                return record_id.rid
+            if record_id.writer is not self:
+                raise ValueError(
+                    '%r belongs to another unflushed batch.' % (record_id))
+            return '$op%d' % (record_id.index)
+        return _rid_format(record_id)
+
+    def _enqueue(self, statement, cache_key=None, touches=(), deletes=None):
+        """Queues ``statement``. ``touches`` lists the references to
+           existing records it modifies, which are dropped from the
+           connection's document cache when it is flushed. ``deletes`` is
+           the record id or ``PendingRecord`` it deletes, whose entries
+           are dropped from the rid cache.
+        """
+        touches = [rid for rid in touches if rid[:1] == '#']
+        record = PendingRecord(
+            self, len(self.queue), statement, cache_key=cache_key,
+            touches=touches, deletes=deletes)
+        self.queue.append(record)
+        if len(self.queue) >= self.batch_size:
+            self.flush()
+        return record
+
+    def create_document(self, class_name, document):
+        """Queues the creation of a document of type ``class_name``."""
+        document = self.db_connection.encode_document(class_name, document)
+        return self._enqueue('INSERT INTO %s CONTENT %s' % (
+            class_name, json.dumps(document)))
+
+    def create_vertex(self, subclass='V', content=None, cache_key=None):
+        """Queues the creation of a vertex with the given content. If
+           ``cache_key`` names a property of ``content``, the new vertex's
+           @rid is added to the connection's rid cache on flush.
+        """
+        statement = 'CREATE VERTEX %s' % (subclass)
+        if content is not None:
+            statement = ' '.join([statement, 'CONTENT', json.dumps(
+                self.db_connection.encode_document(subclass, content))])
+        if cache_key is not None:
+            cache_key = (subclass, cache_key, content[cache_key])
+        return self._enqueue(statement, cache_key=cache_key)
+
+    def create_edge(self, source_id, target_id, subclass='E', content=None):
+        """Queues the creation of an edge. ``source_id`` and ``target_id``
+           may be record ids or ``PendingRecord`` objects returned by
+           this writer.
+        """
+        source_id = self._reference(source_id)
+        target_id = self._reference(target_id)
+        statement = 'CREATE EDGE %s FROM %s TO %s' % (
+            subclass, source_id, target_id)
+        if content is not None:
+            statement = ' '.join([statement, 'CONTENT', json.dumps(
+                self.db_connection.encode_document(subclass, content))])
+        return self._enqueue(statement, touches=(source_id, target_id))
+
+    def update_document(self, record_id, payload, update_mode='full'):
+        """Queues an update of the record ``record_id``. With
+           ``update_mode='full'`` the record's content is replaced by
+           ``payload``; with ``update_mode='partial'`` it is merged.
+        """
+        if update_mode == 'full':
+            operator = 'CONTENT'
+        elif update_mode == 'partial':
+            operator = 'MERGE'
+        else:
+            raise ValueError('Unknown update_mode %r.' % (update_mode))
+        record_id = self._reference(record_id)
+        payload = self.db_connection.encode_document(
+            payload.get('@class'), payload)
+        return self._enqueue('UPDATE %s %s %s' % (
+            record_id, operator, json.dumps(payload)), touches=(record_id,))
+
+    def delete(self, record_id, record_type='document'):
+        """Queues the deletion of ``record_id``. ``record_type`` is one of
+           'document', 'vertex' or 'edge', since OrientDB requires the
+           graph variants for vertices and edges. Once flushed, the record
+           is dropped from the connection's rid and document caches.
+        """
+        commands = {
+            'document': 'DELETE FROM %s',
+            'vertex': 'DELETE VERTEX %s',
+            'edge': 'DELETE EDGE %s'}
+        if record_type not in commands:
+            raise ValueError('Unknown record_type %r.' % (record_type))
+        reference = self._reference(record_id)
+        if not isinstance(record_id, PendingRecord):
+            record_id = reference
+        return self._enqueue(
+            commands[record_type] % (reference), touches=(reference,),
+            deletes=record_id)
+
+    def flush(self):
+        """Sends the queued operations to the server as one batch.
+           Returns the list of ``PendingRecord`` objects that were sent,
+           with their ``rid`` and ``result`` filled in.
+        """
+        chunk = self.queue
+        if len(chunk) == 0:
+            return []
+        self.queue = []
+        script = ['LET op%d = %s' % (i, record.statement)
+                  for i, record in enumerate(chunk)]
+        script.append('RETURN [%s]' % (
+            ', '.join('$op%d' % (i) for i in range(len(chunk)))))
+        operations = [{'type': 'script', 'language': 'sql', 'script': script}]
+        response = _post_batch(
+            self.db_connection, operations, transaction=self.transaction)
+        results = self.db_connection._decode(response)['result']
+        if len(results) != len(chunk):
+            raise OrientDBResponseError(
+                'Batch returned %d results for %d operations.' % (
+                len(results), len(chunk)))
+        rid_cache = self.db_connection.rid_cache
+        for record, result in zip(chunk, results):
+            record.result = result
+            record.rid = _extract_rid(result)
+            record.flushed = True
+            if record.cache_key is not None and record.rid is not None:
+                rid_cache.set(record.cache_key, record.rid)
+            self.db_connection._invalidate(record.touches)
+        deleted = []
+        for record in chunk:
+            target = record.deletes
+            if isinstance(target, PendingRecord):
+                target = target.rid
+            if target is not None:
+                deleted.append(target)
+                self.db_connection._invalidate([target])
+        rid_cache.discard(deleted)
+        return chunk
 
 
 class OrientDBConnection(object):
-    """Class for interfacing with OrientDB via REST interface"""
+    """Class for interfacing with OrientDB via REST interface.
+
+       All requests go through ``self.session``, a pooled keep-alive
+       session holding up to ``pool_size`` connections to the server.
+       Transient failures are retried ``max_retries`` times, sleeping
+       ``backoff_factor * 2 ** (retry - 1)`` seconds between attempts.
+       Queries, which are sent by POST but don't modify the database, go
+       through ``self.query_session`` instead, which retries POSTs too.
+
+       ``rid_cache`` maps (class, property, value) keys to @rids for
+       ``lookup_rid``. It defaults to an in-memory ``LRURidCache``; pass a
+       ``SqliteRidCache`` when the keys don't fit in memory.
+
+       If a ``DocumentCache`` is given as ``document_cache``, whole
+       documents read through ``get_document``, ``get_documents`` and
+       ``select_from`` are cached by @rid, and writes made through this
+       object invalidate the records they touch.
+
+       ``schema`` is a ``SchemaCache``, loaded from the server when it is
+       first needed. It lets ``create_vertex_class``, ``create_edge_class``
+       and ``create_class_property`` skip classes and properties that
+       exist already, and writes encode property values to their schema
+       types without asking the server.
+
+       Every request is timed and measured. The resulting
+       ``RequestMetric`` objects are aggregated in ``self.metrics``, a
+       ``MetricsSummary``, and passed to each function in
+       ``metric_hooks``; more hooks can be added with
+       ``add_metric_hook``.
+    """
     def __init__(self, orientdb_address='http://localhost',
                  orientdb_port=2480, password='', user='', database=None,
-                 to_base64=False, database_type='plocal'):
+                 to_base64=False, database_type='plocal',
+                 pool_size=DEFAULT_POOL_SIZE, max_retries=DEFAULT_MAX_RETRIES,
+                 backoff_factor=DEFAULT_BACKOFF_FACTOR, rid_cache=None,
+                 document_cache=None, metric_hooks=None, schema_cache=None):
         if database is None:
             print 'Warning: no database specified.'
             database = ''
@@ -219,8 +1933,19 @@ class OrientDBConnection(object):
             import base64
             password = base64.b64encode(password)
         auth_url = '/'.join([orientdb_url, 'connect', database])
-        auth_response = requests.get(
-            auth_url, auth=requests.auth.HTTPBasicAuth(user, password))
+        # The session keeps the auth cookie and sends it on every request.
+        self.session = _make_session(
+            pool_size=pool_size, max_retries=max_retries,
+            backoff_factor=backoff_factor)
+        self.query_session = _make_session(
+            pool_size=pool_size, max_retries=max_retries,
+            backoff_factor=backoff_factor, retry_post=True)
+        self.query_session.cookies = self.session.cookies
+        self.metrics = MetricsSummary()
+        self.metric_hooks = list(metric_hooks or [])
+        auth_response = self._request(
+            'get', auth_url, 'connect',
+            auth=requests.auth.HTTPBasicAuth(user, password))
         if str(auth_response.status_code)[0] != '2':
             raise AuthenticationError(
                 'Authentication failed. Got response %s.' % (str(
@@ -236,64 +1961,464 @@ class OrientDBConnection(object):
         self.server_address = (self.orientdb_address + ':' + 
             str(self.orientdb_port))
         self.database_type = database_type
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        if rid_cache is None:
+            rid_cache = LRURidCache()
+        self.rid_cache = rid_cache
+        self.document_cache = document_cache
+        if schema_cache is None:
+            schema_cache = SchemaCache()
+        self.schema = schema_cache
+
+    def close(self):
+        """Closes the pooled connections held by this object."""
+        self.session.close()
+        self.query_session.close()
+
+    def add_metric_hook(self, hook):
+        """Registers ``hook`` to be called with the ``RequestMetric`` of
+           every request made from now on.
+        """
+        self.metric_hooks.append(hook)
+
+    def _record(self, metric):
+        self.metrics.add(metric)
+        for hook in self.metric_hooks:
+            hook(metric)
+
+    def _request(self, method, url, operation, defer=False, **kwargs):
+        """Sends a request through the session and measures it. Unless
+           ``defer`` is set, the metric is recorded right away. With
+           ``defer``, it is recorded by ``_decode`` (or, for streamed
+           responses, once the stream has been read) so that it includes
+           the decode time and row count.
+        """
+        session = self.query_session if operation == 'query' else (
+            self.session)
+        start = time.time()
+        data = kwargs.get('data')
+        try:
+            response = session.request(method, url, **kwargs)
+        except requests.RequestException as e:
+            # no response, e.g. the server couldn't be reached or the
+            # retries ran out, but the attempt still counts as an error
+            self._record(RequestMetric(
+                operation, method.upper(), url, type(e).__name__,
+                time.time() - start, 0.0, len(data) if data else 0, 0))
+            raise
+        wait = response.elapsed.total_seconds()
+        metric = RequestMetric(
+            operation, method.upper(), url, response.status_code, wait,
+            max(0.0, time.time() - start - wait),
+            len(data) if data else 0,
+            0 if kwargs.get('stream') else len(response.content))
+        response.metric = metric
+        if not defer:
+            self._record(metric)
+        return response
+
+    def _decode(self, response):
+        """Decodes the JSON body of a response from ``_request`` with
+           ``defer`` set and records its metric.
+        """
+        metric = response.metric
+        start = time.time()
+        try:
+            data = response.json()
+        except ValueError:
+            metric.decode = time.time() - start
+            self._record(metric)
+            raise
+        metric.decode = time.time() - start
+        if isinstance(data, dict) and isinstance(data.get('result'), list):
+            metric.rows = len(data['result'])
+        else:
+            metric.rows = 1
+        self._record(metric)
+        return data
+
+    def _cache_documents(self, documents):
+        """Adds whole documents read from the server to the document
+           cache, if there is one. Returns ``documents``, or for an
+           iterator, an iterator that caches the documents as they pass.
+        """
+        if self.document_cache is None:
+            return documents
+        def put(document):
+            self.document_cache.put(document)
+            return document
+        if isinstance(documents, list):
+            return map(put, documents)
+        return imap(put, documents)
+
+    def _invalidate(self, record_ids):
+        """Drops records that were written to from the document cache."""
+        if self.document_cache is not None:
+            for record_id in record_ids:
+                if record_id is not None:
+                    self.document_cache.invalidate(record_id)
 
     def database_info(self):
         """Returns information about the current database.
            BROKEN: Might need additional authentication"""
         request_url = '/'.join([
             self.server_address, 'database', self.database])
-        response = requests.get(request_url)
+        response = self._request('get', request_url, 'server')
         return response
 
+    def _schema(self):
+        """Returns ``self.schema``, loading it from the server first if it
+           isn't loaded.
+        """
+        if not self.schema.loaded:
+            self.refresh_schema()
+        return self.schema
+
+    def refresh_schema(self):
+        """Reloads the schema cache from the database metadata. If the
+           server won't describe the schema, the cache is emptied and
+           marked unavailable rather than raising.
+        """
+        request_url = '/'.join([
+            self.server_address, 'database', self.database])
+        response = self._request('get', request_url, 'schema', defer=True)
+        if str(response.status_code)[0] != '2':
+            self._record(response.metric)
+            self.schema.load([], available=False)
+            return
+        self.schema.load(self._decode(response).get('classes') or [])
+
+    def has_class(self, class_name):
+        """Returns True if the class ``class_name`` exists, according to
+           the schema cache.
+        """
+        return self._schema().has_class(class_name)
+
+    def has_property(self, class_name, property_name):
+        """Returns True if ``class_name`` has the property
+           ``property_name``, itself or inherited, according to the schema
+           cache.
+        """
+        return self._schema().property_type(
+            class_name, property_name) is not None
+
+    def encode_document(self, class_name, document):
+        """Returns a copy of ``document`` with its values converted to the
+           form OrientDB expects for the types the schema gives
+           ``class_name``'s properties, e.g. '42' for a LONG property is
+           sent as 42 and a ``datetime`` as '2015-06-01 12:00:00'. Other
+           properties are converted by Python type, with ``@fieldTypes``
+           set for dates, decimals and ``bytearray`` values so that the
+           server stores them with the right type.
+        """
+        types = {}
+        if class_name is not None:
+            types = self._schema().property_types(class_name)
+        encoded = {}
+        field_types = []
+        for name, value in document.iteritems():
+            if name[:1] == '@':
+                encoded[name] = value
+                continue
+            property_type = types.get(name.lower())
+            if property_type is None:
+                code = _field_type_code(value)
+                if code is not None:
+                    field_types.append('%s=%s' % (name, code))
+            encoded[name] = _encode_value(value, property_type)
+        if field_types:
+            if encoded.get('@fieldTypes'):
+                field_types.insert(0, encoded['@fieldTypes'])
+            encoded['@fieldTypes'] = ','.join(field_types)
+        return encoded
+
     def list_databases(self):
         """Returns a list of all the databases."""
         request_url = '/'.join([
             self.server_address, 'listDatabases'])
-        response = requests.get(request_url, cookies=self.auth_cookie)
-        return response.json()['databases']
+        response = self._request(
+            'get', request_url, 'server', defer=True)
+        return self._decode(response)['databases']
+
+    def select_from(self, target, where, page_size=DEFAULT_PAGE_SIZE,
+                    prefetch=True, fields=None, fetch_plan=None, limit=None,
+                    parameters=None, stream=False, as_records=False):
+        """Returns a ``Cursor`` over the documents in ``target`` matching
+           ``where``, which is a SQL condition or a dictionary to match.
+           Documents are fetched ``page_size`` at a time in @rid order.
+           ``parameters`` holds the values of any ``?`` or ``:name``
+           parameters in ``where``, as a list or a dictionary.
 
-    def select_from(self, target, where):
-        """Calls the _select_from method to retrieve documents using
-           the SQL-like language.
+           ``fields`` restricts the documents to the given properties (plus
+           @rid), ``fetch_plan`` sets how linked records are expanded
+           (e.g. ``'*:-2'`` to leave out edges) and ``limit`` caps the
+           total number of documents returned.
+
+           With ``stream`` set, each page is parsed from the response as
+           it arrives, so documents are yielded before the whole page has
+           been received and only one is decoded at a time. Streamed pages
+           are not prefetched.
+
+           With ``as_records`` set, the documents are returned as compact
+           ``Record`` objects instead of dictionaries.
         """
-        if isinstance(where, dict):
-            where = where_clause(where)
-        for result in _select_from(self, target, where):
-            yield result
+        where, parameters = _where_parameters(where, parameters)
+        def fetch_page(after_rid, page_limit):
+            page = _select_from(
+                self, target, where, after_rid=after_rid, limit=page_limit,
+                fields=fields, fetch_plan=fetch_plan, parameters=parameters,
+                stream=stream)
+            if fields is None and fetch_plan is None:
+                page = self._cache_documents(page)
+            return _as_records(page, as_records)
+        return Cursor(fetch_page, page_size=page_size, prefetch=prefetch,
+                      limit=limit)
 
     def check_exists(self, graph_class, document):
         """Check whether an edge or vertex exists containing the document.
            Change this so that it returns a boolean"""
-        where = where_clause(document)
-        return self.select_from(graph_class, where)
+        return self.select_from(graph_class, document)
 
-    def get_document(self, record_id):
+    def lookup_rid(self, class_name, key, value):
+        """Returns the @rid of a record of ``class_name`` whose property
+           ``key`` equals ``value``, or None if there isn't one. Answers
+           from the rid cache when it can, and caches what the server
+           returns otherwise.
+        """
+        cache_key = (class_name, key, value)
+        rid = self.rid_cache.get(cache_key)
+        if rid is not None:
+            return rid
+        for document in self.select_from(
+                class_name, {key: value}, page_size=1, prefetch=False,
+                fields=[key], limit=1):
+            rid = document['@rid']
+            self.rid_cache.set(cache_key, rid)
+            return rid
+        return None
+
+    def get_document(self, record_id, fields=None, fetch_plan=None,
+                     as_records=False):
         """Retrieves one document with the given record_id. The record_id
-           can be prefixed with '#' or not.
+           can be prefixed with '#' or not, or be a ``RID``. ``fields``
+           restricts the document to the given properties, and
+           ``fetch_plan`` sets how linked records are expanded. With
+           ``as_records`` set, the document is returned as a ``Record``.
+
+           Raises a RecordNotFoundError if there is no such record, and an
+           OrientDBResponseError if the server fails otherwise.
         """
-        record_id = record_id.replace('#', '')
-        request_url = '/'.join([
-            self.server_address, 'document', self.database, record_id])
-        response = requests.get(request_url, cookies=self.auth_cookie)
-        return response.json()
+        if as_records:
+            return Record.from_dict(self.get_document(
+                record_id, fields=fields, fetch_plan=fetch_plan))
+        if fields is not None:
+            projection, _ = _projection(fields)
+            query_text = 'SELECT %sFROM %s' % (
+                projection, _rid_format(record_id))
+            results = _restore_rids(_query_page(
+                self, query_text, 'sql', 1, fetch_plan=fetch_plan), fields)
+            if len(results) == 0:
+                raise RecordNotFoundError([_rid_format(record_id)])
+            return results[0]
+        use_cache = self.document_cache is not None and fetch_plan is None
+        if use_cache:
+            document = self.document_cache.get(record_id)
+            if document is not None:
+                return document
+        url_parts = [self.server_address, 'document', self.database,
+                     _rid_format(record_id)[1:]]
+        if fetch_plan is not None:
+            url_parts.append(urllib2.quote(fetch_plan))
+        request_url = '/'.join(url_parts)
+        response = self._request(
+            'get', request_url, 'document', defer=True)
+        if str(response.status_code)[0] != '2':
+            self._record(response.metric)
+            if response.status_code == 404:
+                raise RecordNotFoundError([_rid_format(record_id)])
+            raise _response_error('get_document', response)
+        document = self._decode(response)
+        if use_cache:
+            self.document_cache.put(document)
+        return document
+
+    def get_documents(self, record_ids, chunk_size=DEFAULT_PAGE_SIZE,
+                      concurrent=False, raise_missing=True, as_records=False):
+        """Retrieves the documents with the given record ids, in the same
+           order, with one ``SELECT FROM [#a, #b, ...]`` query per chunk of
+           ``chunk_size`` ids. With ``concurrent`` set, up to ``pool_size``
+           chunks are fetched at the same time.
 
-    def post_command(self, command_text, language='sql'):
+           If any of the records don't exist, raises a
+           ``RecordNotFoundError`` listing them, or, if ``raise_missing``
+           is not set, returns None in their place. With ``as_records``
+           set, the documents are returned as ``Record`` objects.
+        """
+        record_ids = [_rid_format(record_id) for record_id in record_ids]
+        documents = {}
+        if self.document_cache is not None:
+            for record_id in record_ids:
+                document = self.document_cache.get(record_id)
+                if document is not None:
+                    documents[record_id] = document
+        unique_ids = [record_id
+                      for record_id in OrderedDict.fromkeys(record_ids)
+                      if record_id not in documents]
+        def fetch(chunk):
+            query_text = 'SELECT FROM [%s]' % (', '.join(chunk))
+            return _query_page(self, query_text, 'sql', -1)
+        chunks = [unique_ids[i:i + chunk_size]
+                  for i in xrange(0, len(unique_ids), chunk_size)]
+        pages = []
+        if concurrent:
+            for i in xrange(0, len(chunks), self.pool_size):
+                fetches = [_Prefetch(fetch, chunk)
+                           for chunk in chunks[i:i + self.pool_size]]
+                pages.extend(f.result() for f in fetches)
+        else:
+            pages = [fetch(chunk) for chunk in chunks]
+        for page in pages:
+            for document in self._cache_documents(page):
+                documents[document['@rid']] = document
+        missing = [record_id for record_id in unique_ids
+                   if record_id not in documents]
+        if raise_missing and len(missing) > 0:
+            raise RecordNotFoundError(missing)
+        if as_records:
+            for record_id, document in documents.iteritems():
+                documents[record_id] = Record.from_dict(document)
+        return [documents.get(record_id) for record_id in record_ids]
+
+    def post_command(self, command_text, language='sql', parameters=None):
         """Executes a command against the database. In OrientDB, POST commands
            are the ones that can modify the database.
 
-           We're putting the command in the URL, so beware of really long
-           command strings.
+           The command is sent in the request body, so it can be as long
+           as it needs to be. ``parameters`` holds the values of any ``?``
+           (as a list) or ``:name`` (as a dictionary) parameters in it.
+           Commands that change classes or properties clear the schema
+           cache, and commands that may write to records clear the
+           document cache, since the records they touch aren't known.
         """
-        command_text = urllib2.quote(command_text)
-        request_url = '/'.join([self.server_address, 'command',
-                                self.database, language, command_text])
-        response = requests.post(request_url, cookies=self.auth_cookie)
+        response = _post_command(
+            self, command_text, language=language, parameters=parameters)
+        self._command_sent(command_text, language)
         return response
 
-    def get_query(self, query_text, language):
-        """Executes a GET query against the database."""
-        for result in _get_query(self, query_text, language):
-            yield result
+    def _command_sent(self, command_text, language):
+        """Drops what a command sent as-is may have made stale."""
+        if language == 'sql' and _SCHEMA_COMMAND.match(command_text):
+            # the schema may have changed in ways the cache can't follow
+            self.schema.invalidate()
+        if self.document_cache is not None and not (
+                language == 'sql' and _READ_ONLY_COMMAND.match(command_text)):
+            self.document_cache.clear()
+
+    def get_query(self, query_text, language, page_size=DEFAULT_PAGE_SIZE,
+                  prefetch=True, keyset=False, fields=None, fetch_plan=None,
+                  limit=None, parameters=None, stream=False,
+                  as_records=False):
+        """Executes a query against the database and returns a ``Cursor``
+           over the results. ``parameters`` holds the values of any ``?``
+           (as a list) or ``:name`` (as a dictionary) parameters in it.
+
+           The results are fetched in one request, in the query's own
+           order. With ``keyset``, a SQL query is instead paged by @rid,
+           ``page_size`` records at a time, by wrapping it in a subquery.
+           The server runs the whole query again for each page, and only
+           ``SELECT FROM`` and ``TRAVERSE`` queries without ORDER BY can
+           be paged; others raise a ValueError. ``select_from`` pages
+           without those costs.
+
+           ``fields``, ``fetch_plan``, ``limit``, ``stream`` and
+           ``as_records`` work as they do for ``select_from``; ``fields`` is
+           ignored for languages other than SQL. Statements other than
+           SELECT, TRAVERSE, MATCH or EXPLAIN are run once, like
+           ``post_command``, without retries.
+        """
+        keyset = keyset and language == 'sql'
+        if keyset:
+            _check_keyset_query(query_text)
+        else:
+            page_size = None
+        def fetch_page(after_rid, page_limit):
+            return _as_records(_get_query(
+                self, query_text, language, after_rid=after_rid,
+                limit=page_limit, keyset=keyset, fields=fields,
+                fetch_plan=fetch_plan, parameters=parameters, stream=stream),
+                as_records)
+        return Cursor(fetch_page, page_size=page_size, prefetch=prefetch,
+                      limit=limit)
+
+    def traverse(self, record_ids, direction='both', edge_class=None,
+                 max_depth=1, min_depth=1, **kwargs):
+        """Returns a ``Cursor`` over the vertices reachable from
+           ``record_ids`` (a record id or a list of them) by following
+           ``edge_class`` edges (a class name, a list of them, or None for
+           all) in ``direction``, which is 'out', 'in' or 'both'.
+
+           The walk runs on the server as a single breadth-first
+           ``TRAVERSE`` limited to ``max_depth`` hops, so it costs one
+           request rather than one per vertex. Each
+           vertex is returned once, if it is between ``min_depth`` and
+           ``max_depth`` hops away; the start vertices are at depth 0.
+
+           Other arguments (``fields``, ``stream``, ``as_records``,
+           ``keyset`` and ``page_size`` to page the results, ...) are
+           passed on to ``get_query``.
+        """
+        query_text = (
+            'SELECT FROM (TRAVERSE %s FROM %s MAXDEPTH %d '
+            'STRATEGY BREADTH_FIRST) WHERE $depth >= %d' % (
+            _traversal_function(direction, edge_class),
+            _traversal_target(record_ids), max_depth, min_depth))
+        return self.get_query(query_text, 'sql', **kwargs)
+
+    def neighbours(self, record_id, direction='both', edge_class=None,
+                   **kwargs):
+        """Returns a ``Cursor`` over the vertices joined to ``record_id``
+           by an ``edge_class`` edge in ``direction``. See ``traverse``.
+        """
+        return self.traverse(record_id, direction=direction,
+                             edge_class=edge_class, **kwargs)
+
+    def k_hop(self, record_id, k, direction='both', edge_class=None,
+              **kwargs):
+        """Returns a ``Cursor`` over the vertices at most ``k`` hops away
+           from ``record_id``, excluding itself. See ``traverse``.
+        """
+        return self.traverse(record_id, direction=direction,
+                             edge_class=edge_class, max_depth=k, **kwargs)
+
+    def shortest_path(self, source_id, target_id, direction='both',
+                      edge_class=None, max_depth=None, **kwargs):
+        """Returns a ``Cursor`` over the vertices of a shortest path from
+           ``source_id`` to ``target_id``, in path order and including both
+           ends, following ``edge_class`` edges (a class name or None for
+           all) in ``direction``. The path is found on the server with
+           ``shortestPath()``; ``max_depth`` caps its length. The cursor is
+           empty if there is no path.
+
+           Other arguments are passed on to ``get_query``, except
+           ``keyset``: the path is fetched in one request, since paging
+           by @rid would reorder it.
+        """
+        direction = direction.lower()
+        if direction not in DIRECTIONS:
+            raise ValueError('Unknown direction %r.' % (direction))
+        arguments = [_rid_format(source_id), _rid_format(target_id),
+                     "'%s'" % (direction.upper())]
+        if edge_class is not None or max_depth is not None:
+            arguments.append(
+                'null' if edge_class is None else "'%s'" % (edge_class))
+        if max_depth is not None:
+            arguments.append('{"maxDepth": %d}' % (max_depth))
+        query_text = 'SELECT expand(shortestPath(%s))' % (
+            ', '.join(arguments))
+        kwargs['keyset'] = False
+        return self.get_query(query_text, 'sql', **kwargs)
 
     def connections(self):
         """This is broken because it requires the user to be authenticated
@@ -301,53 +2426,116 @@ class OrientDBConnection(object):
         """
         request_url = '/'.join([self.server_address, 'connections',
                                 self.database])
-        response = requests.get(request_url, cookies=self.auth_cookie)
+        response = self._request('get', request_url, 'server')
         return response
     
     def update_document(self, record_id, payload, update_mode='full'):
         """Updates a document by its record-id. Payload is a dictionary.
            Returns the response from the sever."""
+        self._invalidate([record_id])
+        payload = self.encode_document(payload.get('@class'), payload)
         response = _update_document(
             self, record_id, payload, update_mode='full')
         return response
 
-    def export_database(self, file_name):
+    def export_database(self, file_name,
+                        chunk_size=DEFAULT_STREAM_CHUNK_SIZE):
         """Exports the database in JSON format to ``file_name``. Uses the
-           filename extension to guess what type of file you want to export."""
-        request_url = '/'.join([self.server_address, 'export', self.database])
-        response = requests.get(request_url, cookies=self.auth_cookie)
+           filename extension to guess what type of file you want to export.
+
+           The export is streamed to the file ``chunk_size`` bytes at a
+           time (and decompressed on the fly for '.json'), so the size of
+           the database doesn't affect memory use.
+        """
         if file_name.lower()[-7:] == 'json.gz':
             # OrientDB responds with gzip'd data by default
-            f = open(file_name, 'wb')
-            f.write(response.content)
-            f.close()
+            decompressor = None
         elif file_name.lower()[-4:] == 'json':
-            db_dump = gzip.GzipFile(fileobj=StringIO(response.content)).read()
-            f = open(file_name, 'w')
-            f.write(db_dump)
-            f.close()
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
         else:
             raise NotImplementedError(
                 "Unable to infer output filetype from name.")
+        request_url = '/'.join([self.server_address, 'export', self.database])
+        response = self._request(
+            'get', request_url, 'export', defer=True, stream=True)
+        try:
+            if str(response.status_code)[0] != '2':
+                raise OrientDBResponseError(
+                    'Export failed. Got response %s.' % (
+                    response.status_code))
+            f = open(file_name, 'wb')
+            start = time.time()
+            try:
+                for chunk in response.raw.stream(
+                        chunk_size, decode_content=False):
+                    response.metric.response_bytes += len(chunk)
+                    if decompressor is not None:
+                        chunk = decompressor.decompress(chunk)
+                    f.write(chunk)
+                if decompressor is not None:
+                    f.write(decompressor.flush())
+            finally:
+                f.close()
+                response.metric.transfer = time.time() - start
+        finally:
+            response.close()
+            self._record(response.metric)
+
+    def batch(self, batch_size=DEFAULT_BATCH_SIZE, transaction=False):
+        """Returns a ``BatchWriter`` that queues writes and sends them to
+           the server ``batch_size`` at a time, optionally inside a
+           transaction.
+        """
+        return BatchWriter(
+            self, batch_size=batch_size, transaction=transaction)
 
     def class_information(self, class_name):
-        """Returns information about the requested class."""
+        """Returns information about the requested class: its ``name``,
+           ``superClass`` and ``properties``. Classes in the schema cache
+           are answered from it; others are asked of the server and
+           added to the cache.
+        """
+        description = self._schema().get_class(class_name)
+        if description is not None:
+            return description
         request_url = '/'.join([
             self.server_address, 'class', self.database, class_name])
-        response = requests.get(request_url, cookies=self.auth_cookie)
-        return response.json()
+        response = self._request(
+            'get', request_url, 'schema', defer=True)
+        description = self._decode(response)
+        if str(response.status_code)[0] == '2':
+            self.schema.add_class(description)
+        return description
+
+    def _create_class(self, class_name, superclass):
+        """Creates ``class_name`` extending ``superclass`` unless the
+           schema cache has it. Returns the server's response, or None if
+           the class exists.
+        """
+        schema = self._schema()
+        if schema.has_class(class_name):
+            return None
+        response = _post_command(self, 'create class %s extends %s' % (
+            class_name, superclass))
+        if str(response.status_code)[0] == '2':
+            schema.add_class({'name': class_name, 'superClass': superclass,
+                              'properties': []})
+        else:
+            # e.g. created meanwhile by another client
+            schema.invalidate()
+        return response
 
     def create_vertex_class(self, class_name):
-        """Creates a new class that extends the built-in Vertex class.
-           Does not check whether it exists already.
+        """Creates a new class that extends the built-in Vertex class,
+           unless it exists already.
         """
-        self.post_command('create class %s extends V' % (class_name))
+        return self._create_class(class_name, 'V')
 
     def create_edge_class(self, class_name):
-        """Creates a new class that extends the built-in Edge class
-           Does not check whether it exists already.
+        """Creates a new class that extends the built-in Edge class,
+           unless it exists already.
         """
-        self.post_command('create class %s extends E' % (class_name))
+        return self._create_class(class_name, 'E')
 
     def create_document(self, class_name, document):
         """Creates a new document of type ``class_name``. Returns the
@@ -355,59 +2543,396 @@ class OrientDBConnection(object):
         """
         request_url = '/'.join([
             self.server_address, 'document', self.database])
-        payload = copy.deepcopy(document)
+        payload = self.encode_document(class_name, document)
         payload['@class'] = class_name
         payload = json.dumps(payload)
-        response = requests.post(request_url, cookies=self.auth_cookie, data=payload)
+        response = self._request(
+            'post', request_url, 'document', data=payload)
         return response
 
     def create_edge(self, source_id, target_id, subclass='E', content=None):
         """Creates an edge from the vertex with 'source_id' to the vertex
            with 'target_id'. If specified, the edge will in in class
            ``subclass`` and contain the document in the ``content``
-           dictionary. As a convenience, we also check whether the ids have
-           a "#' in front of them, adding it if they don't.
+           dictionary. The ids may be strings, with or without the '#', or
+           ``RID`` objects.
         """
-        if source_id[0] != '#':
-            source_id = '#' + source_id
-        if target_id[0] != '#':
-            target_id = '#' + target_id
+        source_id = _rid_format(source_id)
+        target_id = _rid_format(target_id)
         command_text = 'create edge %s from %s to %s' % (
             subclass, source_id, target_id)
         if content is not None:
-            content = json.dumps(content)
+            content = json.dumps(self.encode_document(subclass, content))
             command_text = ' '.join([command_text, 'content', content])
         # print 'command:', command_text
-        response = self.post_command(command_text)
+        self._invalidate([source_id, target_id])
+        response = _post_command(self, command_text)
         return response
 
     def create_class_property(
         self, class_property, class_name, property_type):
-        """Create a class property."""
+        """Create a class property, unless ``class_name`` has it already
+           (in which case None is returned and its type is not changed).
+        """
+        schema = self._schema()
+        if schema.property_type(class_name, class_property) is not None:
+            return None
         request_url = '/'.join([
             self.server_address, 'property', self.database, class_name,
             class_property, property_type.upper()])
         # print request_url
-        response = requests.post(request_url, cookies=self.auth_cookie)
+        response = self._request('post', request_url, 'schema')
+        if (str(response.status_code)[0] == '2' and
+                schema.has_class(class_name)):
+            schema.add_property(class_name, class_property, property_type)
+        else:
+            schema.invalidate()
         return response
 
-    # TODO: Fill in routine to check whether vertex exists already
-    #       Use the "check_exists" method.
-    def create_vertex(self, subclass='V', content=None, ignore=False):
+    @_check_response_code
+    def create_index(self, class_name, properties,
+                     index_type=DEFAULT_INDEX_TYPE, index_name=None):
+        """Creates an index of type ``index_type`` (one of ``INDEX_TYPES``)
+           on ``properties`` of ``class_name``, which is a property name
+           or a list of them for a composite index. The index is named
+           ``class_name.property`` by default, as OrientDB names automatic
+           indexes. The properties must have been created already (see
+           ``create_class_property``).
+        """
+        if isinstance(properties, basestring):
+            properties = [properties]
+        index_type = index_type.upper()
+        if index_type not in INDEX_TYPES:
+            raise ValueError('Unknown index_type %r.' % (index_type))
+        if index_name is None:
+            index_name = '%s.%s' % (class_name, '_'.join(properties))
+        return self.post_command('create index %s on %s (%s) %s' % (
+            index_name, class_name, ', '.join(properties), index_type))
+
+    @_check_response_code
+    def drop_index(self, index_name):
+        """Drops the index called ``index_name``."""
+        return self.post_command('drop index %s' % (index_name))
+
+    @_check_response_code
+    def rebuild_index(self, index_name='*'):
+        """Rebuilds the index called ``index_name``, or all the automatic
+           indexes with the default of '*'.
+        """
+        return self.post_command('rebuild index %s' % (index_name))
+
+    def list_indexes(self, class_name=None):
+        """Returns the indexes of the database, or of ``class_name`` only,
+           as described by the server's index manager. Each one is a
+           dictionary with the index's ``name`` and ``type``, and
+           ``fields``, the list of properties it covers.
+        """
+        indexes = _query_page(
+            self, 'SELECT expand(indexes) FROM metadata:indexmanager',
+            'sql', -1)
+        result = []
+        for index in indexes:
+            definition = index.get('indexDefinition') or {}
+            if (class_name is not None and
+                    (definition.get('className') or '').lower() !=
+                    class_name.lower()):
+                continue
+            index['fields'] = _index_fields(index)
+            result.append(index)
+        return result
+
+    def ensure_index(self, class_name, properties,
+                     index_type=DEFAULT_INDEX_TYPE, index_name=None):
+        """Creates an index like ``create_index`` unless ``class_name``
+           already has an index on exactly ``properties``. Returns True if
+           an index was created.
+        """
+        if isinstance(properties, basestring):
+            properties = [properties]
+        for index in self.list_indexes(class_name):
+            if index['fields'] == list(properties):
+                return False
+        self.create_index(class_name, properties, index_type=index_type,
+                          index_name=index_name)
+        return True
+
+    def explain(self, query_text, parameters=None):
+        """Returns the server's execution plan for the SQL query
+           ``query_text`` as a dictionary, with ``uses_index`` added: True
+           if the query reads from an index rather than scanning the
+           whole class. The query is not run.
+        """
+        results = _query_page(
+            self, 'EXPLAIN ' + query_text, 'sql', -1, parameters=parameters)
+        if len(results) == 0:
+            raise OrientDBResponseError(
+                'No execution plan for %r.' % (query_text))
+        plan = results[0]
+        plan['uses_index'] = _uses_index(plan)
+        return plan
+
+    def explain_select(self, target, where, parameters=None,
+                       page_size=DEFAULT_PAGE_SIZE, fields=None):
+        """Explains the first page query of ``select_from`` (and so of
+           ``check_exists`` and ``lookup_rid``) with the same arguments.
+        """
+        where, parameters = _where_parameters(where, parameters)
+        return self.explain(
+            _select_query(target, where, limit=page_size, fields=fields),
+            parameters=parameters)
+
+    def create_vertex(self, subclass='V', content=None, ignore=False,
+                      cache_key=None, key=None):
         """Create a vertex with the given content. If ``ignore`` is set, then
            fail silently if there is already a vertex with the same content.
+           If ``cache_key`` names a property of ``content``, the new vertex's
+           @rid is added to the rid cache under that property's value.
+
+           With ``ignore``, the vertex is written with a single ``UPDATE ...
+           UPSERT``, matching existing vertices on the properties named in
+           ``key`` (a property name or a list of them; all of ``content``
+           by default). The other properties of an existing vertex are
+           merged from ``content``. A unique index on ``key`` makes the
+           match an index lookup and guards against concurrent creates.
+
+           With ``ignore`` or ``cache_key``, an OrientDBResponseError is
+           raised if the server refuses the write.
         """
-        if ignore:
-            pass # check whether vertex with the same content exists
-                 # if so, just return
-        command_text = 'create vertex %s' % (subclass)
+        parameters = None
+        encoded = None
         if content is not None:
-            content = json.dumps(content)
-            command_text = ' '.join([command_text, 'content', content])
+            encoded = self.encode_document(subclass, content)
+        if ignore:
+            if content is None or len(content) == 0:
+                raise ValueError('ignore=True needs content to match on.')
+            if key is None:
+                match = dict((k, v) for k, v in encoded.iteritems()
+                             if k[:1] != '@')
+            else:
+                if isinstance(key, basestring):
+                    key = [key]
+                match = dict((k, encoded[k]) for k in key)
+            where, parameters = compile_where(match)
+            command_text = (
+                'update %s merge %s upsert return after where %s' % (
+                subclass, json.dumps(encoded), where))
+        else:
+            command_text = 'create vertex %s' % (subclass)
+            if content is not None:
+                command_text = ' '.join([
+                    command_text, 'content', json.dumps(encoded)])
         # print 'command:', command_text
-        response = self.post_command(command_text)
+        response = _post_command(self, command_text, parameters=parameters)
+        if (ignore or cache_key is not None) and (
+                str(response.status_code)[0] != '2'):
+            raise _response_error('create_vertex', response)
+        if ignore:
+            # the upsert may have merged content into an existing vertex
+            self._invalidate([_extract_rid(response.json()['result'])])
+        if cache_key is not None:
+            rid = _extract_rid(response.json()['result'])
+            if rid is not None:
+                self.rid_cache.set(
+                    (subclass, cache_key, content[cache_key]), rid)
         return response
 
+    def create_vertices(self, subclass, documents, key,
+                        chunk_size=DEFAULT_BATCH_SIZE, merge=False):
+        """Creates a vertex of class ``subclass`` for each document in
+           ``documents`` unless one with the same value of the property
+           ``key`` exists already (i.e. "INSERT IGNORE"). With ``merge``
+           set, the other properties of the document are merged into the
+           existing vertex instead. Returns the list of @rids of the
+           vertices, existing or new, in input order.
+
+           Each chunk of ``chunk_size`` documents costs one ``WHERE key IN
+           [...]`` query for the values not already in the rid cache, and
+           one batch request to create the missing vertices. Found and
+           created @rids are added to the rid cache.
+        """
+        rids = []
+        for start in xrange(0, len(documents), chunk_size):
+            chunk = documents[start:start + chunk_size]
+            found = {}
+            unknown = []
+            for document in chunk:
+                value = document[key]
+                if value in found:
+                    continue
+                found[value] = self.rid_cache.get((subclass, key, value))
+                if found[value] is None:
+                    unknown.append(value)
+            if len(unknown) > 0:
+                query_text = (
+                    'SELECT @rid AS %s, %s FROM %s WHERE %s IN :values' % (
+                    _RID_ALIAS, key, subclass, key))
+                for result in _query_page(self, query_text, 'sql', -1,
+                                          parameters={'values': unknown}):
+                    value, rid = result[key], result[_RID_ALIAS]
+                    found[value] = rid
+                    self.rid_cache.set((subclass, key, value), rid)
+            with self.batch(batch_size=len(chunk)) as batch:
+                for document in chunk:
+                    value = document[key]
+                    if found[value] is None:
+                        found[value] = batch.create_vertex(
+                            subclass=subclass, content=document,
+                            cache_key=key)
+                    elif merge and len(document) > 1:
+                        batch.update_document(
+                            found[value], document, update_mode='partial')
+            for document in chunk:
+                rid = found[document[key]]
+                if isinstance(rid, PendingRecord):
+                    rid = rid.rid
+                rids.append(rid)
+        return rids
+
+class AsyncCursor(object):
+    """Asynchronous counterpart of ``Cursor``. ``next_page()`` returns a
+       future for the next page of results, which is an empty list once
+       the query is exhausted. Pages are fetched in order even if
+       ``next_page()`` is called again before the previous one is done.
+    """
+    def __init__(self, cursor, executor):
+        self.cursor = cursor
+        self.executor = executor
+        self.lock = threading.Lock()
+        self.after_rid = None
+        self.fetched = 0
+        self.exhausted = False
+
+    def _next_page(self):
+        with self.lock:
+            if self.exhausted:
+                return []
+            page = list(self.cursor._fetch(self.after_rid, self.fetched))
+            self.fetched += len(page)
+            self.cursor.rows_fetched += len(page)
+            if self.cursor._is_last_page(len(page), self.fetched):
+                self.exhausted = True
+            else:
+                self.after_rid = self.cursor._last_rid(page[-1])
+            return page
+
+    def next_page(self):
+        """Returns a future for the next page of results."""
+        return self.executor.submit(self._next_page)
+
+    def fetch_all(self):
+        """Returns a future for the list of all the remaining results."""
+        def fetch():
+            results = []
+            page = self._next_page()
+            while len(page) > 0:
+                results.extend(page)
+                page = self._next_page()
+            return results
+        return self.executor.submit(fetch)
+
+
+class AsyncOrientDBConnection(object):
+    """Non-blocking client with the same surface as ``OrientDBConnection``.
+       Every method returns a ``concurrent.futures.Future`` (cursors are
+       ``AsyncCursor`` objects), so a caller can have many requests in
+       flight at once and collect the results later.
+
+       The calls run on a thread pool of ``max_workers`` threads (by
+       default the connection's ``pool_size``). They all share the
+       wrapped connection's session, so the in-flight requests are
+       multiplexed over its pool of keep-alive connections.
+
+       Needs the ``futures`` package on Python 2.
+    """
+    def __init__(self, db_connection, max_workers=None):
+        from concurrent.futures import ThreadPoolExecutor
+        if max_workers is None:
+            max_workers = db_connection.pool_size
+        self.db_connection = db_connection
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self, wait=True):
+        """Shuts down the thread pool, by default after the requests in
+           flight have finished.
+        """
+        self.executor.shutdown(wait=wait)
+
+    def submit(self, f, *args, **kwargs):
+        """Calls ``f(db_connection, *args, **kwargs)`` on the thread pool
+           and returns a future for its result.
+        """
+        return self.executor.submit(f, self.db_connection, *args, **kwargs)
+
+    def _call(self, method_name, *args, **kwargs):
+        method = getattr(self.db_connection, method_name)
+        return self.executor.submit(method, *args, **kwargs)
+
+    def select_from(self, target, where, **kwargs):
+        """Returns an ``AsyncCursor`` over the results of ``select_from``."""
+        kwargs['prefetch'] = False
+        kwargs['stream'] = False
+        cursor = self.db_connection.select_from(target, where, **kwargs)
+        return AsyncCursor(cursor, self.executor)
+
+    def get_query(self, query_text, language, **kwargs):
+        """Returns an ``AsyncCursor`` over the results of ``get_query``."""
+        kwargs['prefetch'] = False
+        kwargs['stream'] = False
+        cursor = self.db_connection.get_query(query_text, language, **kwargs)
+        return AsyncCursor(cursor, self.executor)
+
+    def _cursor(self, method_name, *args, **kwargs):
+        kwargs['prefetch'] = False
+        kwargs['stream'] = False
+        cursor = getattr(self.db_connection, method_name)(*args, **kwargs)
+        return AsyncCursor(cursor, self.executor)
+
+    def traverse(self, *args, **kwargs):
+        return self._cursor('traverse', *args, **kwargs)
+
+    def neighbours(self, *args, **kwargs):
+        return self._cursor('neighbours', *args, **kwargs)
+
+    def k_hop(self, *args, **kwargs):
+        return self._cursor('k_hop', *args, **kwargs)
+
+    def shortest_path(self, *args, **kwargs):
+        return self._cursor('shortest_path', *args, **kwargs)
+
+    def get_document(self, *args, **kwargs):
+        return self._call('get_document', *args, **kwargs)
+
+    def get_documents(self, *args, **kwargs):
+        return self._call('get_documents', *args, **kwargs)
+
+    def lookup_rid(self, *args, **kwargs):
+        return self._call('lookup_rid', *args, **kwargs)
+
+    def post_command(self, *args, **kwargs):
+        return self._call('post_command', *args, **kwargs)
+
+    def create_document(self, *args, **kwargs):
+        return self._call('create_document', *args, **kwargs)
+
+    def create_vertex(self, *args, **kwargs):
+        return self._call('create_vertex', *args, **kwargs)
+
+    def create_vertices(self, *args, **kwargs):
+        return self._call('create_vertices', *args, **kwargs)
+
+    def create_edge(self, *args, **kwargs):
+        return self._call('create_edge', *args, **kwargs)
+
+    def update_document(self, *args, **kwargs):
+        return self._call('update_document', *args, **kwargs)
+
 # {u'name': u'Pigpen_Weir', u'in_sung_by': [u'#9:69', u'#9:117', u'#9:227', u'#9:66', u'#9:39', u'#9:378', u'#9:634', u'#9:641'], u'@fieldTypes': u'in_sung_by=g', u'@rid': u'#9:258', u'type': u'artist', u'@version': 11, u'@type': u'd', u'@class': u'V'}
 # {u'name': u'Robert_Johnson', u'type': u'artist', u'@rid': u'#9:261', u'in_written_by': u'#9:69', u'@version': 4, u'@type': u'd', u'@class': u'V'}
 
@@ -419,6 +2944,8 @@ def main():
         print i
         # document = orient_connection.get_document(i['@rid'])
         # print document
+    # rids = [i['@rid'] for i in orient_connection.select_from('v', "type = 'artist'")]
+    # documents = orient_connection.get_documents(rids)
     # import pdb; pdb.set_trace()
     experiment_payload = {
         'foo': 'baz', u'name': u'Willie_Cobb', u'type': u'artist',
@@ -429,7 +2956,7 @@ def main():
     orient_connection.update_document('#9:806', experiment_payload)
     # select in() from Restaurant where name = 'Dante')
     # def _get_query(db_connection, query_text, language, skip=0):
-    for result in orient_connection.get_query("select in() from V where name = 'Willie_Cobb'", 'sql'):
+    for result in orient_connection.get_query("select in() from V where name = 'Willie_Cobb'", 'sql', keyset=False):
         print result
     # result = orient_connection.create_edge('#9:117', '#9:261')
     # orient_connection.select_from('v', "")
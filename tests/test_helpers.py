@@ -0,0 +1,212 @@
+"""Tests of py2orientdb's and bulk_import's helpers that need no server.
+
+    python -m unittest discover tests
+"""
+
+import bz2
+import gzip
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import bulk_import
+import py2orientdb
+
+
+def chunked(text, size):
+    return [text[i:i + size] for i in xrange(0, len(text), size)]
+
+
+class IterJSONArrayTest(unittest.TestCase):
+    document = {
+        'before': {'a': [1, {'b': '}]'}]},
+        'result': [
+            {'@rid': '#9:1', 'name': 'quote " and \\ backslash'},
+            [1, 2.5e3, -7, True, False, None],
+            u'unicode \xe9',
+            12345678901234567890,
+            {}, []],
+        'after': 'x'}
+
+    def test_any_chunk_size(self):
+        text = json.dumps(self.document)
+        for size in (1, 2, 3, 7, 64, len(text)):
+            self.assertEqual(
+                list(py2orientdb.iter_json_array(chunked(text, size),
+                                                 'result')),
+                self.document['result'])
+
+    def test_escape_at_end_of_chunk(self):
+        text = '{"result": ["a\\"b", "c\\\\"]}'
+        for size in range(1, len(text) + 1):
+            self.assertEqual(
+                list(py2orientdb.iter_json_array(chunked(text, size),
+                                                 'result')),
+                ['a"b', 'c\\'])
+
+    def test_empty_and_missing(self):
+        self.assertEqual(
+            list(py2orientdb.iter_json_array(['{"result": []}'], 'result')),
+            [])
+        self.assertEqual(
+            list(py2orientdb.iter_json_array(['{"other": [1]}'], 'result')),
+            [])
+
+    def test_truncated(self):
+        for text in ('{"result": [1, 2', '{"result": [{"a": 1',
+                     '{"result": ["abc'):
+            with self.assertRaises(ValueError):
+                list(py2orientdb.iter_json_array(chunked(text, 3), 'result'))
+
+    def test_malformed(self):
+        for text in ('{"result": [tru]}', '{"result": [12a]}',
+                     '{"result": [{"a": 1]]}'):
+            with self.assertRaises(ValueError):
+                list(py2orientdb.iter_json_array([text], 'result'))
+
+
+class CompileWhereTest(unittest.TestCase):
+    def test_nested_values_become_parameters(self):
+        clause, parameters = py2orientdb.compile_where(
+            {'e': True, 'a': {'b': 1, 'c': {'d': 'x"y'}}})
+        self.assertEqual(clause, 'a.b = :p0 AND a.c.d = :p1 AND e = :p2')
+        self.assertEqual(parameters, {'p0': 1, 'p1': 'x"y', 'p2': True})
+
+    def test_same_keys_same_clause(self):
+        self.assertEqual(py2orientdb.compile_where({'a': 1, 'b': 2})[0],
+                         py2orientdb.compile_where({'b': 3, 'a': 4})[0])
+
+    def test_empty(self):
+        with self.assertRaises(Exception):
+            py2orientdb.compile_where({})
+
+
+class RecordTest(unittest.TestCase):
+    def test_metadata(self):
+        record = py2orientdb.Record.from_dict({
+            '@rid': '#9:1', '@version': 2, '@class': 'V', '@type': 'd',
+            '@fieldTypes': 'link=x', 'link': '#9:2', 'uri': 'a'})
+        for name in ('@rid', '@version', '@class', '@type', '@fieldTypes',
+                     'uri'):
+            self.assertIn(name, record)
+        self.assertEqual(record['@rid'], py2orientdb.RID(9, 1))
+        self.assertEqual(record['@type'], 'd')
+        self.assertEqual(record['link'], py2orientdb.RID(9, 2))
+        self.assertEqual(record.keys(), ['link', 'uri'])
+        self.assertEqual(record.to_dict()['@rid'], '#9:1')
+
+    def test_missing_metadata(self):
+        record = py2orientdb.Record.from_dict({'uri': 'a'})
+        self.assertNotIn('@rid', record)
+        self.assertIsNone(record.get('@rid'))
+        self.assertRaises(KeyError, lambda: record['@class'])
+
+
+class DocumentCacheTest(unittest.TestCase):
+    def test_copies(self):
+        cache = py2orientdb.DocumentCache()
+        document = {'@rid': '#9:1', '@version': 1, 'tags': ['a']}
+        cache.put(document)
+        document['tags'].append('b')
+        cached = cache.get('#9:1')
+        self.assertEqual(cached['tags'], ['a'])
+        cached['tags'].append('c')
+        self.assertEqual(cache.get('9:1')['tags'], ['a'])
+
+    def test_keeps_newer_version(self):
+        cache = py2orientdb.DocumentCache()
+        cache.put({'@rid': '#9:1', '@version': 2, 'n': 'new'})
+        cache.put({'@rid': '#9:1', '@version': 1, 'n': 'old'})
+        self.assertEqual(cache.get('#9:1')['n'], 'new')
+
+
+class MetricsSummaryTest(unittest.TestCase):
+    def test_max_is_exact(self):
+        summary = py2orientdb.MetricsSummary(sample_size=1)
+        for latency in (1.0, 5.0, 2.0):
+            summary.add(py2orientdb.RequestMetric(
+                'query', 'POST', 'url', 200, latency, 0.0, 0, 0))
+        summary.add(py2orientdb.RequestMetric(
+            'query', 'POST', 'url', 'ConnectionError', 0.5, 0.0, 0, 0))
+        totals = summary.summary()['query']
+        self.assertEqual(totals['max'], 5.0)
+        self.assertEqual((totals['count'], totals['errors']), (4, 1))
+
+
+class DecompressedStreamTest(unittest.TestCase):
+    data = ''.join('line %d\n' % (i) for i in xrange(5000))
+
+    def read(self, compressed, make_decompressor):
+        stream = io.BufferedReader(bulk_import._DecompressedStream(
+            io.BytesIO(compressed), make_decompressor))
+        return stream.read()
+
+    def test_gzip_members(self):
+        compressed = ''
+        for part in (self.data[:1000], self.data[1000:]):
+            f = io.BytesIO()
+            g = gzip.GzipFile(fileobj=f, mode='wb')
+            g.write(part)
+            g.close()
+            compressed += f.getvalue()
+        self.assertEqual(
+            self.read(compressed,
+                      lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)),
+            self.data)
+
+    def test_bz2_members(self):
+        compressed = (bz2.compress(self.data[:1000]) +
+                      bz2.compress(self.data[1000:]))
+        self.assertEqual(self.read(compressed, bz2.BZ2Decompressor),
+                         self.data)
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'checkpoint')
+        self.inputs = []
+        for name in ('a.nt', 'b.nt'):
+            file_name = os.path.join(self.directory, name)
+            with open(file_name, 'w') as f:
+                f.write('<a> <b> <c> .\n')
+            self.inputs.append(file_name)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_inputs_are_kept_apart(self):
+        checkpoint = bulk_import.Checkpoint(self.path)
+        checkpoint.save(self.inputs[0], offset=10, rows=1)
+        checkpoint.save(self.inputs[1], offset=20, rows=2)
+        reloaded = bulk_import.Checkpoint(self.path)
+        self.assertEqual(reloaded.load(self.inputs[0])['offset'], 10)
+        self.assertEqual(reloaded.load(self.inputs[1])['offset'], 20)
+
+    def test_changed_input_is_ignored(self):
+        bulk_import.Checkpoint(self.path).save(self.inputs[0], offset=10)
+        with open(self.inputs[0], 'a') as f:
+            f.write('<d> <e> <f> .\n')
+        self.assertIsNone(bulk_import.Checkpoint(self.path).load(
+            self.inputs[0]))
+
+    def test_single_input_format(self):
+        state = bulk_import.Checkpoint(None)._identity(self.inputs[0])
+        state.update({'file': os.path.abspath(self.inputs[0]), 'offset': 5})
+        with open(self.path, 'w') as f:
+            json.dump(state, f)
+        self.assertEqual(
+            bulk_import.Checkpoint(self.path).load(self.inputs[0])['offset'],
+            5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+"""Tests of the client against the mock server in benchmarks/.
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, 'benchmarks'))
+
+import mock_orientdb
+import py2orientdb
+
+
+class MockServerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = mock_orientdb.MockOrientDBServer().start()
+        self.connection = py2orientdb.OrientDBConnection(
+            orientdb_address='http://127.0.0.1',
+            orientdb_port=self.server.port, user='root', password='root',
+            database=self.server.database_name, backoff_factor=0.001,
+            document_cache=py2orientdb.DocumentCache())
+        self.rids = mock_orientdb.generate_graph(
+            self.server.database, 25, 50, seed=0)
+
+    def tearDown(self):
+        self.connection.close()
+        self.server.stop()
+
+    def fail_commands(self, count):
+        """Makes the next ``count`` query and command requests fail with a
+           503, as a busy server would. Returns the list of the requests'
+           bodies.
+        """
+        bodies = []
+        route_command = mock_orientdb.MockOrientDBHandler.route_command
+        state = {'failures': count}
+        def flaky(handler, method, parts, body):
+            bodies.append(body)
+            if state['failures'] > 0:
+                state['failures'] -= 1
+                return handler.send_json({'errors': ['busy']}, status=503)
+            return route_command(handler, method, parts, body)
+        mock_orientdb.MockOrientDBHandler.route_command = flaky
+        self.addCleanup(setattr, mock_orientdb.MockOrientDBHandler,
+                        'route_command', route_command)
+        return bodies
+
+    def test_select_from_pages(self):
+        for kwargs in ({'page_size': 7}, {'page_size': 7, 'stream': True},
+                       {'page_size': None}, {'as_records': True}):
+            rids = [str(r['@rid']) for r in self.connection.select_from(
+                'node', None, **kwargs)]
+            self.assertEqual(sorted(rids), sorted(self.rids))
+
+    def test_get_documents(self):
+        documents = self.connection.get_documents(self.rids[::-1])
+        self.assertEqual([d['@rid'] for d in documents], self.rids[::-1])
+        with self.assertRaises(py2orientdb.RecordNotFoundError):
+            self.connection.get_document('#9999:1')
+
+    def test_read_only_query_is_retried(self):
+        bodies = self.fail_commands(1)
+        results = list(self.connection.get_query('SELECT FROM node', 'sql'))
+        self.assertEqual(len(results), len(self.rids))
+        self.assertEqual(len(bodies), 2)
+
+    def test_write_through_get_query_is_not_retried(self):
+        self.connection.get_document(self.rids[0])
+        bodies = self.fail_commands(1)
+        with self.assertRaises(py2orientdb.OrientDBResponseError):
+            list(self.connection.get_query(
+                'UPDATE node SET seen = true', 'sql'))
+        self.assertEqual(len(bodies), 1)
+        self.assertEqual(len(self.connection.document_cache), 0)
+
+    def test_failed_request_is_recorded(self):
+        metrics = []
+        self.connection.add_metric_hook(metrics.append)
+        self.server.stop()
+        # drop the kept-alive connection, which the server still serves
+        self.connection.session.close()
+        with self.assertRaises(Exception):
+            self.connection.get_document(self.rids[0])
+        self.assertEqual(metrics[-1].status, 'ConnectionError')
+
+
+if __name__ == '__main__':
+    unittest.main()